@@ -2,18 +2,23 @@
 
 import sampler
 import threshold
+import store
 import numpy as np
+import argparse
 import entropy 
 import os
 import sys
 
+parser = argparse.ArgumentParser(description='ABC of the entropy model with the initial weights as parameters')
+parser.add_argument('--resume', action='store_true', help='continue the run checkpointed in ./populations instead of starting a new one')
+args = parser.parse_args()
+
+model = entropy.EntropyModel(entropy.loadCosts('../data/costMatrixSea.csv'), '../data/cities_weights.csv')
+
 def postfn(params):
 #    print('postfn, params:',params) 
-    entropy.loadCosts('../data/costMatrixSea.csv')
-    sites = '../data/cities_weights.csv'
-
     experiment = entropy.Experiment(0, params[0], params[1], 0, params[2:])
-    simSites = entropy.runEntropy(experiment, sites, False)
+    simSites = model.run(experiment, False)
     return simSites
 
 sites = '../data/cities_weights.csv'
@@ -31,14 +36,20 @@ rightBounds[1] = 2
 
 priors = sampler.TophatPrior(leftBounds, rightBounds)
 
-sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=entropy.distRelative, threads=16)
+sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=entropy.DistRelative(data), threads=16)
+
+# every generation is checkpointed, and with --resume a restarted run continues after the last stored one
+populations = store.PopulationStore('populations')
 
-for pool in sampler.sample(priors, eps):
+pool = None
+for pool in sampler.sample(priors, eps, populations, resume=args.resume):
     print("T: {0}, eps: {1:>.4f}, ratio: {2:>.4f}".format(pool.t, pool.eps, pool.ratio))
     for i, (mean, std) in enumerate(zip(np.mean(pool.thetas, axis=0), np.std(pool.thetas, axis=0))):
         print(u"    theta[{0}]: {1:>.4f} \u00B1 {2:>.4f}".format(i, mean,std))
     np.savetxt("result_"+str('%.2f')%pool.eps+'.csv', pool.thetas, delimiter=";", fmt='%1.5f')
 
-print(pool.thetas)
-np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
+# a resumed run that was already complete yields no generation
+if pool is not None:
+    print(pool.thetas)
+    np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
 
@@ -2,20 +2,29 @@
 
 import sampler
 import threshold
+import store
 import mpi_util
 
 import numpy as np
 import entropy 
 import os
 import sys
+import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+parser = argparse.ArgumentParser(description='ABC of the entropy model on MPI. Rank 0 runs the sampler and the other ranks the simulations')
+parser.add_argument('--local-workers', type=int, default=1, help='simulations run at once by each worker rank with a local pool (hybrid mode: start one rank per node)')
+parser.add_argument('--local-executor', choices=['process', 'thread'], default='process', help='local pool of the hybrid mode')
+parser.add_argument('--resume', action='store_true', help='continue the run checkpointed in ./populations instead of starting a new one')
+args = parser.parse_args()
+
+model = entropy.EntropyModel(entropy.loadCosts('../data/costMatrixSea.csv'), '../data/cities_weights.csv')
 
 def postfn(params):
     print('postfn, params:',params) 
-    entropy.loadCosts('../data/costMatrixSea.csv')
-    sites = '../data/cities_weights.csv'
-
     experiment = entropy.Experiment(0, params[0], params[1], params[2])
-    simSites = entropy.runEntropy(experiment, sites, False)
+    simSites = model.run(experiment, False)
     return simSites
 
 sites = '../data/cities_weights.csv'
@@ -24,18 +33,43 @@ data = entropy.loadHistoricalSites(sites)
 eps = threshold.LinearEps(15, 200, 150)
 priors = sampler.TophatPrior([0,0,0],[2,2,10])
 
-mpi_pool = mpi_util.MpiPool()
-sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=entropy.distRelative, pool=mpi_pool)
+# rank 0 runs the sampler and the other ranks simulate the particles it sends them
+mpi_pool = mpi_util.MpiWorkerPool(slots=args.local_workers)
+if not mpi_pool.isMaster():
+    if args.local_workers > 1:
+        # the processes of a node share the memory-mapped cost matrix of the datacache
+        if args.local_executor == 'thread':
+            localPool = ThreadPool(args.local_workers)
+        else:
+            # forked so that the local workers do not run this script (and MPI) again
+            localPool = multiprocessing.get_context('fork').Pool(args.local_workers)
+        mpi_pool.wait(localPool.map)
+        localPool.close()
+    else:
+        mpi_pool.wait()
+    sys.exit(0)
+
+sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=entropy.DistRelative(data), pool=mpi_pool, scheduler='dynamic')
+
+# every generation is checkpointed, and with --resume a restarted run continues after the last stored one
+populations = store.PopulationStore('populations')
 
-for pool in sampler.sample(priors, eps):
-    logFile = open('general_'+str(os.getpid())+'.txt', 'a')
-    logFile.write('starting eps: '+str(pool.eps)+'\n')
-    logFile.close()
-    print("T: {0}, eps: {1:>.4f}, ratio: {2:>.4f}".format(pool.t, pool.eps, pool.ratio))
-    for i, (mean, std) in enumerate(zip(np.mean(pool.thetas, axis=0), np.std(pool.thetas, axis=0))):
-        print(u"    theta[{0}]: {1:>.4f} \u00B1 {2:>.4f}".format(i, mean,std))
-    np.savetxt("result_"+str('%.2f')%pool.eps+'.csv', pool.thetas, delimiter=";", fmt='%1.5f')
+pool = None
+try:
+    for pool in sampler.sample(priors, eps, populations, resume=args.resume):
+        logFile = open('general_'+str(os.getpid())+'.txt', 'a')
+        logFile.write('starting eps: '+str(pool.eps)+'\n')
+        logFile.close()
+        print("T: {0}, eps: {1:>.4f}, ratio: {2:>.4f}".format(pool.t, pool.eps, pool.ratio))
+        for i, (mean, std) in enumerate(zip(np.mean(pool.thetas, axis=0), np.std(pool.thetas, axis=0))):
+            print(u"    theta[{0}]: {1:>.4f} \u00B1 {2:>.4f}".format(i, mean,std))
+        np.savetxt("result_"+str('%.2f')%pool.eps+'.csv', pool.thetas, delimiter=";", fmt='%1.5f')
 
-print(pool.thetas)
-np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
+    # a resumed run that was already complete yields no generation
+    if pool is not None:
+        print(pool.thetas)
+        np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
+finally:
+    # the workers wait until they are released, also if the sampler fails
+    mpi_pool.close()
 
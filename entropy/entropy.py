@@ -1,58 +1,211 @@
 #!/usr/bin/python3
 
-import csv, math, sys, argparse, random
+import math, sys, argparse, random, threading, copy, warnings
 import numpy as np
 from scipy.stats.stats import pearsonr
+from scipy import sparse
 
-def distAbs(x,y):  
-    xValues = np.array([site.size for site in x])
-    yValues = np.array([site.weight for site in y])
-    diff = np.sum(np.absolute(xValues-yValues))
-    print('diff abs:',diff)
-    return diff
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def distRelative(x,y):
-    if x[0].weight == -1 and y[0].weight == -1:
-        return sys.float_info.max
+import datacache, sinks
+
+# 'numpy' or 'numba', see setBackend
+backend = 'numpy'
+
+def setBackend(name):
+    """
+    Selects the implementation of the plain entropy iteration: 'numpy', 'numba' or 'auto' (numba if installed).
+    It falls back to 'numpy' if numba is not installed. Compiled kernels are cached on disk (see NUMBA_CACHE_DIR)
+
+    :returns backend: the selected backend
+    """
+    global backend
+    if name not in ('numpy', 'numba', 'auto'):
+        raise ValueError('unknown backend: '+str(name))
+    if name!='numpy' and numba is None:
+        if name=='numba':
+            warnings.warn('numba is not installed, using the numpy backend')
+        name = 'numpy'
+    elif name=='auto':
+        name = 'numba'
+    backend = name
+    return backend
+
+def _entropyIteration(kernel, weights, alpha, changeRate, maxIter, maxIterOut, tolerance):
+    # same iteration as MatrixEngine.run without acceleration, written as explicit loops for numba
+    # weights are updated in place
+    numSites = weights.shape[0]
+    weightAlpha = np.empty(numSites)
+    share = np.empty(numSites)
+    variation = np.empty(numSites)
+
+    i = 0
+    iterOut = 0
+    test = tolerance
+    while i<maxIter and iterOut<maxIterOut:
+        if test>tolerance:
+            iterOut = 0
+        else:
+            iterOut += 1
+
+        for j in range(numSites):
+            weightAlpha[j] = weights[j]**alpha
+        for j in range(numSites):
+            totalFlow = 0.0
+            for k in range(numSites):
+                totalFlow += kernel[j,k]*weightAlpha[k]
+            share[j] = weights[j]/totalFlow
+            variation[j] = 0.0
+        for j in range(numSites):
+            for k in range(numSites):
+                variation[k] += kernel[j,k]*share[j]
+
+        aggregatedFlow = 0.0
+        aggregatedDiff = 0.0
+        for k in range(numSites):
+            variation[k] *= weightAlpha[k]
+            realDiff = variation[k]-weights[k]
+            weights[k] += changeRate*realDiff
+            aggregatedFlow += variation[k]
+            aggregatedDiff += abs(realDiff)
+
+        test = aggregatedDiff/aggregatedFlow
+        i += 1
+    return i
+
+if numba is not None:
+    _entropyIteration = numba.njit(cache=True, nogil=True)(_entropyIteration)
+
+def _simulatedWeights(x):
+    # weights of a SiteTable, or an array of weights (one row per simulation)
+    if isinstance(x, SiteTable):
+        return x.weight
+    return np.asarray(x, dtype=float)
 
-    # take size
-    xValues = None
-    yValues = None
+class DistAbs:
+    """
+    Sum of absolute differences between observed sizes and simulated weights
 
+    :param observed: SiteTable with the historical sizes
+    :param verbose: print each computed distance
+    """
+
+    def __init__(self, observed, verbose=False):
+        self.observed = np.array(observed.size)
+        self.verbose = verbose
+
+    def batch(self, weights):
+        """
+        :param weights: K x N array with the final weights of K simulations
+
+        :returns dists: distance of each simulation
+        """
+        diff = np.sum(np.absolute(self.observed-weights), axis=-1)
+        if self.verbose:
+            print('diff abs:',diff)
+        return diff
+
+    def __call__(self, x, y=None):
+        """
+        Distance of one simulation, with the signature used by sampler.Sampler (y is the observed data set)
+        """
+        return self.batch(_simulatedWeights(x))
+
+class DistRelative:
+    """
+    Sum of absolute differences of log sizes, after rescaling the simulated weights to the range of the observed sizes.
+    Log and range of the observed sizes are computed once
+
+    :param observed: SiteTable with the historical sizes
+    :param verbose: print each computed distance
+    """
+
+    def __init__(self, observed, verbose=False):
+        self.minObserved = np.min(observed.size)
+        self.rangeObserved = np.max(observed.size)-self.minObserved
+        # logarithmic to penalize huge sites
+        self.logObserved = np.log(observed.size)
+        self.verbose = verbose
+
+    def batch(self, weights):
+        """
+        :param weights: K x N array with the final weights of K simulations (-1 for invalid runs)
+
+        :returns dists: distance of each simulation (sys.float_info.max for invalid runs)
+        """
+        weights = np.atleast_2d(weights)
+        minWeights = np.min(weights, axis=1, keepdims=True)
+        maxWeights = np.max(weights, axis=1, keepdims=True)
+        # normalize and transform weights to sizes (invalid runs are overwritten below)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sizes = (weights-minWeights)/(maxWeights-minWeights)*self.rangeObserved+self.minObserved
+            diff = np.sum(np.absolute(np.log(sizes)-self.logObserved), axis=1)
+        diff[weights[:,0]==-1] = sys.float_info.max
+        if self.verbose:
+            print('diff:',diff)
+        return diff
+
+    def __call__(self, x, y=None):
+        """
+        Distance of one simulation, with the signature used by sampler.Sampler (y is the observed data set)
+        """
+        return self.batch(_simulatedWeights(x))[0]
+
+def distAbs(x,y,verbose=False):  
+    """
+    Distance between historical data x and simulation y, see DistAbs
+    """
+    return DistAbs(x, verbose)(y)
+
+def distRelative(x,y,verbose=False):
+    """
+    Distance between historical data and a simulation given in any order, see DistRelative
+    """
+    if x.weight[0] == -1 and y.weight[0] == -1:
+        return sys.float_info.max
     # x is data, y is sim
-    if x[0].weight == -1:
-        xValues = np.array([site.size for site in x])
-        yValues = np.array([site.weight for site in y])
-        # normalize
-        yValues = (yValues-min(yValues))/(max(yValues)-min(yValues))
-        # transform weights to sizes
-        yValues = yValues*(max(xValues)-min(xValues))+min(xValues)
-       
+    if x.weight[0] == -1:
+        return DistRelative(x, verbose)(y)
     # y is data, x is sim
-    else:
-        yValues = np.array([site.size for site in y])
-        xValues = np.array([site.weight for site in x])
-        # normalize
-        xValues = (xValues-min(xValues))/(max(xValues)-min(xValues))
-        # transform weights to sizes
-        xValues = xValues*(max(yValues)-min(yValues))+min(yValues)
-
-    # logarithmic to penalize huge sites
-    xValues = np.log(xValues)
-    yValues = np.log(yValues)
- 
-    diff = 0
-    for i in range(len(xValues)):
-        diff += abs(xValues[i]-yValues[i])
-
-    print('diff:',diff)
-    return diff
+    return DistRelative(y, verbose)(x)
 
-class Site:
+class SiteTable:
+    """
+    Settlements stored as aligned NumPy columns
 
-    sites = list()
-    cost = {}
-    weightedCost = {}
+    :param ids: site identifiers (strings)
+    :param size: observed size of each site
+    :param x: x coordinate of each site
+    :param y: y coordinate of each site
+    :param weight: initial weight of each site (-1 for historical data)
+    :param isHarbour: True for sites with a harbour
+    """
+
+    def __init__(self, ids, size, x, y, weight, isHarbour):
+        self.ids = np.asarray(ids)
+        self.size = np.asarray(size, dtype=float)
+        self.x = np.asarray(x).astype(int)
+        self.y = np.asarray(y).astype(int)
+        self.initialWeight = np.array(np.broadcast_to(weight, self.size.shape), dtype=float)
+        self.weight = np.copy(self.initialWeight)
+        self.isHarbour = np.asarray(isHarbour, dtype=bool)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __str__(self):
+        result = ''
+        for i in range(len(self.ids)):
+            result += 'site '+self.ids[i]+' size: '+str(self.size[i])+' weight: {0:.5f}'.format(self.weight[i])+'\n'
+        return result
+
+class Site:
+    """
+    Single site used by the reference loop engine (runLoop)
+    """
 
     def __init__(self, ident, size, x, y, weight, isHarbour):
         self.ident = ident
@@ -68,21 +221,21 @@ class Site:
     def __eq__(self, other):
         return self.ident == other.ident
 
-    def computeFlow(self):
+    def computeFlow(self, sites, weightedCost):
         # total flow
         totalFlow = 0
-        for siteK in Site.sites:
+        for siteK in sites:
             if siteK.ident==self.ident:
                 continue
             codeK = self.ident+'_'+siteK.ident
-            totalFlow +=  siteK.weightAlpha * Site.weightedCost[codeK]
+            totalFlow +=  siteK.weightAlpha * weightedCost[codeK]
         # for each site divide value and add to their variation
         flowToGive = 0
-        for site in Site.sites:
+        for site in sites:
             if site.ident==self.ident:
                 continue
             code = self.ident+'_'+site.ident
-            flow = self.weight*site.weightAlpha * Site.weightedCost[code]
+            flow = self.weight*site.weightAlpha * weightedCost[code]
             flow /= totalFlow
             flowToGive += flow
             site.variation += flow
@@ -108,98 +261,602 @@ class Experiment:
         self.weights = weights
 
         self.changeRate = 0.1
+        # stopping criterion of the iteration (see MatrixEngine.run)
+        self.tolerance = 0.1
+        self.maxIter = 5000
+        # None for the plain damped update or 'anderson' (needs tolerance<=andersonTolerance)
+        self.acceleration = None
+        # iterations executed by the last run, and whether it was accelerated (anderson is not used with alpha>=1)
+        self.iterations = 0
+        self.accelerated = False
+        # sparse kernel: drop pairs with kernel below kernelThreshold or beyond the kernelNeighbours cheapest ones
+        self.kernelThreshold = None
+        self.kernelNeighbours = None
+        # fraction of the kernel mass dropped by the sparse kernel, set by EntropyModel.approximationError
+        # (the runs do not compute it, it needs the dense kernel)
+        self.droppedMass = 0
+
+    def parameters(self):
+        """
+        Returns the parameters of the experiment as a vector (alpha, beta, harbourBonus and initial weights if any)
+        """
+        if self.weights is None:
+            return np.array([self.alpha, self.beta, self.harbourBonus])
+        return np.r_[self.alpha, self.beta, self.harbourBonus, self.weights]
 
     def __str__(self):
         result = 'experiment: '+str(self.numRun)+' alpha: '+str('%.2f')%self.alpha+' beta: '+str('%.2f')%self.beta+' harbour bonus: '+str('%.2f')%self.harbourBonus
         return result
 
 def loadHistoricalSites( inputFileName ):
-    sites = list()
-    inputFile = open(inputFileName, 'r')
-    
-    csvReader = csv.reader(inputFile, delimiter=',')
-    headerLine = next(csvReader)
-
-    for siteLine in csvReader:
-        ident = siteLine[0]
-        size = float(siteLine[1])
-        x = float(siteLine[3])
-        y = float(siteLine[4])
-
-        isHarbour = False
-        isHarbourNum = int(siteLine[7])
-        if isHarbourNum!=0:
-            isHarbour = True
-
-        sites.append(Site(ident, size, x, y, -1, isHarbour))
-    return sites    
+    columns = datacache.loadSiteColumns(inputFileName)
+    return SiteTable(columns.ids, columns.size, columns.x, columns.y, -1, columns.isHarbour)
     
 def loadSites( inputFileName, harbourBonus, weights):
-    inputFile = open(inputFileName, 'r')
-    
-    # all prom and farming must be between 1 (best value) and 0 (worst value)
-    csvReader = csv.reader(inputFile, delimiter=',')
-    headerLine = next(csvReader)
+    columns = datacache.loadSiteColumns(inputFileName)
 
-    i = 0
-    for siteLine in csvReader:
-        ident = siteLine[0]
-        size = float(siteLine[1])
-        x = float(siteLine[3])
-        y = float(siteLine[4])
-
-        # if no predefined weights then random sample from 1-100
-        if weights is None:
-            weight = 1
-        else:
-            weight = weights[i]
-        i += 1
+    # if no predefined weights then all sites start with 1
+    if weights is None:
+        weight = np.ones(len(columns.ids))
+    else:
+        weight = np.array(weights, dtype=float)
+    weight += weight*harbourBonus*columns.isHarbour
+    return SiteTable(columns.ids, columns.size, columns.x, columns.y, weight, columns.isHarbour)
 
-        isHarbour = False
-        isHarbourNum = int(siteLine[7])
-        if isHarbourNum!=0:
-            isHarbour = True
-            weight += weight*harbourBonus
-        Site.sites.append(Site(ident, size, x, y, weight, isHarbour))
+# cost matrix used by runEntropy and runEntropyBatch
+_costs = None
 
 def loadCosts( distFileName):
-    distFile = open(distFileName, 'r')
-    csvReader = csv.reader(distFile, delimiter=';')
-    # skip header
-    next(csvReader)
-
-    for dist in csvReader:
-        code = dist[0]
-        cost = float(dist[1])
-        Site.cost[code] = cost
-
-def computeBetaCosts(beta):
-    for code,cost in Site.cost.items():
-        Site.weightedCost[code] = math.exp(-1.0*beta*cost)
-
-def computeAlphaWeights(alpha):
-    for site in Site.sites:
-        site.weightAlpha = math.pow(site.weight, alpha)
+    """
+    Loads a cost matrix. It is also kept as the cost matrix of runEntropy and runEntropyBatch
+
+    :returns costs: datacache.CostMatrix
+    """
+    global _costs
+    _costs = datacache.loadCostMatrix(distFileName)
+    return _costs
+
+def costMatrix(costs, sites):
+    """
+    Returns the dense cost matrix index-aligned with a SiteTable
+    """
+    return alignedCosts(costs, sites.ids)
+
+def alignedCosts(costs, ids):
+    """
+    Returns the dense cost matrix index-aligned with a list of site ids
+    """
+    index = {ident: i for i, ident in enumerate(costs.ids)}
+    idx = np.array([index[ident] for ident in ids])
+    # avoid copying large matrices that are already aligned
+    if np.array_equal(idx, np.arange(len(costs.ids))) and not np.any(np.diagonal(costs.costs)):
+        return costs.costs
+    aligned = np.array(costs.costs[np.ix_(idx,idx)])
+    np.fill_diagonal(aligned, 0)
+    return aligned
+
+def computeKernel(costs, beta):
+    """
+    Returns exp(-beta*cost) for all pairs of sites with a zero diagonal (a site does not interact with itself)
+    """
+    kernel = np.exp(-1.0*beta*costs)
+    np.fill_diagonal(kernel, 0)
+    return kernel
+
+def rankCosts(costs, chunkSize=1024):
+    """
+    Sorts the pairs of each site by cost, cheapest first, without the site itself. For beta>0 this is also the order of
+    the kernel, so the ranking is computed once per cost matrix and shared by the sparse kernels of all runs
+
+    :param costs: N x N cost matrix (e.g. memory-mapped)
+    :param chunkSize: number of rows sorted at once
+
+    :returns order, sortedCosts: N x N-1 arrays with the index and the cost of the pairs of each site
+    """
+    numSites = costs.shape[0]
+    order = np.empty([numSites, numSites-1], dtype=np.int32)
+    sortedCosts = np.empty([numSites, numSites-1])
+    for start in range(0, numSites, chunkSize):
+        end = min(start+chunkSize, numSites)
+        chunk = np.array(costs[start:end], dtype=float)
+        local = np.arange(end-start)
+        # the site itself is sorted last (after any infinite cost) and dropped
+        chunk[local, start+local] = np.nan
+        ranked = np.argsort(chunk, axis=1, kind='stable')[:,:-1]
+        order[start:end] = ranked
+        sortedCosts[start:end] = np.take_along_axis(chunk, ranked, axis=1)
+    return order, sortedCosts
 
-def runEntropy(experiment, sites, storeResults):
-    Site.sites = list()
-    loadSites(sites, experiment.harbourBonus, experiment.weights)
+def computeSparseKernel(costs, beta, threshold=None, k=None, ranking=None, computeMass=False):
+    """
+    Returns exp(-beta*cost) as a sparse matrix that only keeps the significant interactions.
+    The kernel decreases with the cost, so the kept pairs of each site are a prefix of its cost ranking: the threshold
+    is turned into the cost cutoff -log(threshold)/beta and exp is only computed for the kept pairs.
+    The cheapest pair of each site is always kept, so no site is isolated
+
+    :param costs: N x N cost matrix (e.g. memory-mapped)
+    :param beta: beta of the experiment (not negative)
+    :param threshold: (optional) pairs with a kernel value below threshold are dropped
+    :param k: (optional) only the k cheapest pairs of each site are kept
+    :param ranking: (optional) rankCosts(costs), computed if not given
+    :param computeMass: (optional) also compute the dropped kernel mass, which needs the kernel of all the pairs
+
+    :returns kernel, droppedMass: scipy.sparse csr matrix and fraction of the total kernel mass that was dropped
+        (None without computeMass)
+    """
+    if beta<0:
+        raise ValueError('the sparse kernel needs beta>=0, got '+str(beta))
+    if ranking is None:
+        ranking = rankCosts(costs)
+    order, sortedCosts = ranking
+    numSites, numPairs = order.shape
+
+    # number of kept pairs of each site
+    kept = np.ones(numSites, dtype=int)
+    if k is None and threshold is None:
+        kept[:] = numPairs
+    if k is not None:
+        kept = np.maximum(kept, min(k, numPairs))
+    if threshold is not None:
+        if threshold<=0 or (beta==0 and threshold<=1):
+            cutoff = np.inf
+        elif beta==0:
+            cutoff = -np.inf
+        else:
+            cutoff = -np.log(threshold)/beta
+        # only the columns up to the widest kept prefix are compared
+        width = 1
+        while width<numPairs and np.any(sortedCosts[:,width-1]<=cutoff):
+            width = min(2*width, numPairs)
+        kept = np.maximum(kept, np.sum(sortedCosts[:,:width]<=cutoff, axis=1))
+
+    width = np.max(kept)
+    mask = np.arange(width)<kept[:,None]
+    data = np.exp(-1.0*beta*sortedCosts[:,:width][mask])
+    indptr = np.zeros(numSites+1, dtype=np.int64)
+    np.cumsum(kept, out=indptr[1:])
+    kernel = sparse.csr_matrix((data, order[:,:width][mask], indptr), shape=(numSites, numSites))
+    # pairs whose kernel underflows to 0 do not interact
+    kernel.eliminate_zeros()
+
+    droppedMass = None
+    if computeMass:
+        totalMass = np.sum(np.exp(-1.0*beta*sortedCosts))
+        droppedMass = 1-np.sum(kernel.data)/totalMass
+    return kernel, droppedMass
+
+# loosest tolerance accepted by MatrixEngine.run with acceleration
+andersonTolerance = 1e-3
+
+class MatrixEngine:
+    """
+    NumPy implementation of the entropy iteration. It replaces the loop over Site objects with whole-array operations.
+    The kernel can be dense or a scipy.sparse matrix (see computeSparseKernel)
+
+    :param kernel: matrix with exp(-beta*cost), index-aligned with weights
+    :param weights: initial weight of each site
+    """
+
+    def __init__(self, kernel, weights):
+        self.kernel = kernel
+        self.weights = np.array(weights, dtype=float)
+
+    def computeVariation(self, alpha):
+        """
+        Returns the weight received by each site given the current weights
+        """
+        weightAlpha = np.power(self.weights, alpha)
+        # total flow from each site to the rest
+        totalFlow = self.kernel.dot(weightAlpha)
+        # each site receives a share of every other site's weight
+        return weightAlpha*self.kernel.T.dot(self.weights/totalFlow)
+
+    def step(self, alpha, changeRate):
+        """
+        Computes the flows of one iteration and applies the variations
+
+        :returns aggregatedFlow, aggregatedDiff: total exchanged flow and total absolute variation
+        """
+        variation = self.computeVariation(alpha)
+        realDiff = variation-self.weights
+        self.weights += changeRate*realDiff
+        return np.sum(variation), np.sum(np.absolute(realDiff))
+
+    def run(self, alpha, changeRate, maxIter=5000, maxIterOut=10, tolerance=0.1, acceleration=None):
+        """
+        Iterates until aggregatedDiff/aggregatedFlow stays below tolerance for maxIterOut steps.
+        After the call self.accelerated tells if AndersonMixing was actually used
+
+        The stopping test bounds the size of a step, not the distance to the equilibrium: at the default tolerance
+        the plain and the accelerated iteration both stop far from it, at different points. Acceleration is therefore
+        only accepted with tolerance<=andersonTolerance, where both approach the equilibrium. Even then, with alpha
+        close to 1 the extrapolation can settle in a different equilibrium than the plain iteration
+
+        :param acceleration: (optional) None for the plain damped update or 'anderson' for AndersonMixing
+
+        :returns i: number of executed iterations
+        """
+        self.accelerated = False
+        if acceleration is None and backend=='numba' and not sparse.issparse(self.kernel):
+            return _entropyIteration(np.ascontiguousarray(self.kernel), self.weights, alpha, changeRate, maxIter, maxIterOut, tolerance)
+
+        if acceleration is None:
+            step = self.step
+        elif acceleration=='anderson':
+            if tolerance>andersonTolerance:
+                raise ValueError('anderson acceleration needs tolerance<=%g, got %g' % (andersonTolerance, tolerance))
+            # with alpha>=1 flows concentrate in a few sites and there are several equilibria
+            # the extrapolation can settle in an unstable one, so only the damped update is used
+            if alpha<1:
+                step = AndersonMixing(self).step
+                self.accelerated = True
+            else:
+                step = self.step
+        else:
+            raise ValueError('unknown acceleration: '+str(acceleration))
 
-    # if any value is negative in particle then return max dist
-    if experiment.alpha < 0 or experiment.beta < 0:
-        print('returning 1 because:',experiment.alpha, experiment.beta)
-        for site in Site.sites:
-            site.weight = -1
-        return Site.sites
+        i = 0
+        iterOut = 0
+        test = tolerance
+        while i<maxIter and iterOut<maxIterOut:
+            if test>tolerance:
+                iterOut = 0
+            else:
+                iterOut += 1
+            aggregatedFlow, aggregatedDiff = step(alpha, changeRate)
+            test = aggregatedDiff/aggregatedFlow
+            i += 1
+        return i
 
-    computeBetaCosts(experiment.beta)
+class AndersonMixing:
+    """
+    Anderson acceleration of the damped weight update of a MatrixEngine.
+    The next weights are extrapolated from the last <memory> iterates. An extrapolated step is rejected, and
+    the plain damped step taken instead, if it produces non-positive weights or a larger variation than the
+    previous iterate. The history is dropped after each rejection, and after maxRejected rejections
+    only damped steps are taken
+
+    :param engine: MatrixEngine whose weights are updated
+    :param memory: number of previous iterates used in the extrapolation
+    :param maxStep: maximum length of the extrapolated step, in damped steps
+    :param maxRejected: number of rejected extrapolations before falling back to the damped update
+    """
+
+    def __init__(self, engine, memory=5, maxStep=5.0, maxRejected=20):
+        self.engine = engine
+        self.memory = memory
+        self.maxStep = maxStep
+        self.maxRejected = maxRejected
+        self.lastWeights = None
+        self.lastDiff = None
+        # damped step from the last iterate, used if the extrapolation is rejected
+        self.fallback = None
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        self.weightSteps = list()
+        self.diffSteps = list()
+
+    def step(self, alpha, changeRate):
+        """
+        Same contract as MatrixEngine.step
+
+        :returns aggregatedFlow, aggregatedDiff: total exchanged flow and total absolute variation
+        """
+        variation = self.engine.computeVariation(alpha)
+        realDiff = variation-self.engine.weights
+
+        if self.fallback is not None and np.linalg.norm(realDiff)>np.linalg.norm(self.lastDiff):
+            self.rejected += 1
+            self.reset()
+            self.engine.weights = self.fallback
+            variation = self.engine.computeVariation(alpha)
+            realDiff = variation-self.engine.weights
+        elif self.lastWeights is not None:
+            self.weightSteps.append(self.engine.weights-self.lastWeights)
+            self.diffSteps.append(realDiff-self.lastDiff)
+            if len(self.diffSteps)>self.memory:
+                self.weightSteps.pop(0)
+                self.diffSteps.pop(0)
+
+        weights = self.engine.weights
+        self.lastWeights = weights
+        self.lastDiff = realDiff
+        self.fallback = None
+
+        newWeights = weights+changeRate*realDiff
+        if len(self.diffSteps)>0 and self.rejected<self.maxRejected:
+            diffSteps = np.array(self.diffSteps).T
+            weightSteps = np.array(self.weightSteps).T
+            gamma = np.linalg.lstsq(diffSteps, realDiff, rcond=None)[0]
+            accelerated = newWeights-(weightSteps+changeRate*diffSteps).dot(gamma)
+            # trust region: the extrapolated step cannot be longer than maxStep damped steps
+            stepLength = np.linalg.norm(accelerated-weights)
+            maxLength = self.maxStep*changeRate*np.linalg.norm(realDiff)
+            if stepLength>maxLength:
+                accelerated = weights+(accelerated-weights)*maxLength/stepLength
+            if np.all(np.isfinite(accelerated)) and np.all(accelerated>0):
+                self.fallback = newWeights
+                newWeights = accelerated
+            else:
+                self.rejected += 1
+                self.reset()
+
+        self.engine.weights = newWeights
+        return np.sum(variation), np.sum(np.absolute(realDiff))
+
+# bytes of the kernel stack of BatchEngine, about the size of the L2 cache
+batchCacheBytes = 1 << 20
+
+def batchSlots(numSites):
+    """
+    Returns the default number of slots of BatchEngine: as many N x N kernels as fit in batchCacheBytes (at least 2)
+    """
+    return max(2, batchCacheBytes//(8*numSites*numSites))
+
+class BatchEngine:
+    """
+    Runs the entropy iteration for K parameter sets with whole-array operations on a stack of slots.
+    Each slot iterates one member with its own convergence state. When a member finishes, the next one is loaded
+    into its slot (its kernel is computed in place), so the stack stays full and small enough to stay in the CPU cache.
+    The stack is only compacted once the queue is empty and half of the slots are idle
+
+    :param costs: N x N cost matrix, index-aligned with weights
+    :param betas: array of K beta values
+    :param weights: K x N initial weights
+    :param slots: (optional) number of members iterated at once (default batchSlots(N)). Memory is slots*N*N
+    """
+
+    def __init__(self, costs, betas, weights, slots=None):
+        self.costs = costs
+        self.betas = np.asarray(betas, dtype=float)
+        self.weights = np.array(weights, dtype=float)
+        self.iterations = np.zeros(len(self.weights), dtype=int)
+        self.slots = slots or batchSlots(costs.shape[0])
+
+    def _loadKernel(self, kernel, beta):
+        np.multiply(self.costs, -1.0*beta, out=kernel)
+        np.exp(kernel, out=kernel)
+        np.fill_diagonal(kernel, 0)
+
+    def run(self, alphas, changeRate, maxIter=5000, maxIterOut=10, tolerance=0.1):
+        """
+        Iterates each member with the same stopping rule as MatrixEngine.run
+
+        :returns iterations: number of executed iterations of each member
+        """
+        alphas = np.asarray(alphas, dtype=float)
+        numMembers = len(self.weights)
+        numSlots = min(self.slots, numMembers)
+        numSites = self.weights.shape[1]
+
+        # state of each slot: member, kernel, weights and convergence
+        members = np.arange(numSlots)
+        kernels = np.empty([numSlots, numSites, numSites])
+        for slot in range(numSlots):
+            self._loadKernel(kernels[slot], self.betas[slot])
+        weights = self.weights[:numSlots].copy()
+        slotAlphas = alphas[:numSlots].copy()
+        slotIterations = np.zeros(numSlots, dtype=int)
+        iterOut = np.zeros(numSlots, dtype=int)
+        test = np.full(numSlots, tolerance)
+        active = np.ones(numSlots, dtype=bool)
+        nextMember = numSlots
+
+        while active.any():
+            iterOut = np.where(test>tolerance, 0, iterOut+1)
+
+            weightAlpha = np.power(weights, slotAlphas[:,None])
+            totalFlow = np.matmul(kernels, weightAlpha[:,:,None])[:,:,0]
+            variation = weightAlpha*np.matmul((weights/totalFlow)[:,None,:], kernels)[:,0,:]
+            realDiff = variation-weights
+            weights += changeRate*realDiff
+            test = np.absolute(realDiff).sum(axis=1)/variation.sum(axis=1)
+            slotIterations += 1
+
+            finished = active & ((slotIterations>=maxIter) | (iterOut>=maxIterOut))
+            if not finished.any():
+                continue
+            for slot in np.flatnonzero(finished):
+                self.weights[members[slot]] = weights[slot]
+                self.iterations[members[slot]] = slotIterations[slot]
+                if nextMember<numMembers:
+                    members[slot] = nextMember
+                    self._loadKernel(kernels[slot], self.betas[nextMember])
+                    weights[slot] = self.weights[nextMember]
+                    slotAlphas[slot] = alphas[nextMember]
+                    slotIterations[slot] = 0
+                    iterOut[slot] = 0
+                    test[slot] = tolerance
+                    nextMember += 1
+                else:
+                    active[slot] = False
+
+            # idle slots are still iterated (their results are ignored) until it pays to copy the stack
+            if 0<np.count_nonzero(active)<=len(active)//2:
+                keep = np.flatnonzero(active)
+                members = members[keep]
+                kernels = kernels[keep]
+                weights = weights[keep]
+                slotAlphas = slotAlphas[keep]
+                slotIterations = slotIterations[keep]
+                iterOut = iterOut[keep]
+                test = test[keep]
+                active = active[keep]
+        return self.iterations
+
+class EquilibriumCache:
+    """
+    Bounded cache of converged weights keyed by the parameters of the experiment.
+    A new run starts from the equilibrium of the closest cached parameters instead of the initial weights.
+    The least recently used entry is evicted when the cache is full. It is meant to live in each worker process
+
+    The iteration stops where the steps become small, not at the equilibrium, so a warm started run stops at a different
+    point than a cold one. At the default tolerance of 0.1 the final weights differ by orders of magnitude, and the
+    distances by tens of percent. Runs with a cache therefore need tolerance<=maxTolerance (see accepts).
+    Every checkEvery hits the run is repeated from the initial weights to measure the error of the warm start
+
+    :param maxSize: maximum number of cached equilibria
+    :param scale: (optional) scale of each parameter used in the distance (e.g. the prior range)
+    :param maxDistance: (optional) cached equilibria further than this distance are not used
+    :param maxTolerance: (optional) loosest experiment tolerance for which the cache is used
+    :param checkEvery: (optional) number of hits between two error checks (0 to disable them)
+    :param dist: (optional) distance with a batch method (e.g. DistRelative) used to report the distance error of the checks
+    """
+
+    def __init__(self, maxSize=256, scale=None, maxDistance=np.inf, maxTolerance=1e-6, checkEvery=0, dist=None):
+        self.maxSize = maxSize
+        self.scale = scale
+        self.maxDistance = maxDistance
+        self.maxTolerance = maxTolerance
+        self.checkEvery = checkEvery
+        self.dist = dist
+        self.thetas = None
+        self.weights = list()
+        self.lastUsed = np.zeros(maxSize, dtype=int)
+        self.clock = 0
+        # the cache can be shared by the threads of a worker
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coldIterations = 0
+        self.warmIterations = 0
+        # runs with alpha>=1, which are not cached
+        self.skipped = 0
+        # relative errors of the checked hits
+        self.weightErrors = list()
+        self.distErrors = list()
+
+    def accepts(self, experiment):
+        """
+        True if the cache is used for the experiment: alpha<1, where the equilibrium is unique. Other runs are counted
+        as skipped. Raises ValueError if the tolerance of the experiment is looser than maxTolerance
+        """
+        if experiment.tolerance>self.maxTolerance:
+            raise ValueError('the equilibrium cache needs tolerance<=%g, got %g' % (self.maxTolerance, experiment.tolerance))
+        if experiment.alpha<1:
+            return True
+        with self.lock:
+            self.skipped += 1
+        return False
+
+    def _distances(self, theta):
+        diff = self.thetas[:len(self.weights)]-theta
+        if self.scale is not None:
+            diff = diff/self.scale
+        return np.sqrt(np.sum(diff*diff, axis=1))
+
+    def lookup(self, theta):
+        """
+        Returns the cached weights closest to theta, or None if there is no cached equilibrium close enough
+        """
+        with self.lock:
+            self.clock += 1
+            if len(self.weights)>0:
+                distances = self._distances(theta)
+                nearest = np.argmin(distances)
+                if distances[nearest]<=self.maxDistance:
+                    self.lastUsed[nearest] = self.clock
+                    return self.weights[nearest]
+        return None
+
+    def store(self, theta, weights, iterations, warm):
+        """
+        Stores the equilibrium reached by theta and keeps the iteration statistics
+
+        :param iterations: number of iterations of the run
+        :param warm: True if the run started from a cached equilibrium
+        """
+        with self.lock:
+            if warm:
+                self.hits += 1
+                self.warmIterations += iterations
+            else:
+                self.misses += 1
+                self.coldIterations += iterations
+
+            if self.thetas is None:
+                self.thetas = np.empty([self.maxSize, len(theta)])
+            if len(self.weights)<self.maxSize:
+                idx = len(self.weights)
+                self.weights.append(None)
+            else:
+                idx = np.argmin(self.lastUsed)
+            self.thetas[idx] = theta
+            self.weights[idx] = np.copy(weights)
+            self.lastUsed[idx] = self.clock
+
+    def checkDue(self):
+        """
+        True if the next hit should be checked against a run from the initial weights
+        """
+        with self.lock:
+            return self.checkEvery>0 and self.hits%self.checkEvery==0
+
+    def check(self, warmWeights, coldWeights):
+        """
+        Records the error of a warm started run compared to the same run from the initial weights
+        """
+        weightError = np.sum(np.absolute(warmWeights-coldWeights))/np.sum(np.absolute(coldWeights))
+        distError = None
+        if self.dist is not None:
+            warmDist, coldDist = self.dist.batch(np.array([warmWeights, coldWeights]))
+            distError = abs(warmDist-coldDist)/coldDist
+        with self.lock:
+            self.weightErrors.append(weightError)
+            if distError is not None:
+                self.distErrors.append(distError)
+
+    def hitRate(self):
+        lookups = self.hits+self.misses
+        if lookups==0:
+            return 0
+        return self.hits/lookups
+
+    def iterationsSaved(self):
+        """
+        Returns the mean number of iterations saved by each hit, compared to the mean of the cold runs
+        """
+        if self.hits==0 or self.misses==0:
+            return 0
+        return self.coldIterations/self.misses-self.warmIterations/self.hits
+
+    def __str__(self):
+        result = 'equilibrium cache - size: '+str(len(self.weights))+' hit rate: '+str('%.2f')%self.hitRate()+' iterations saved per hit: '+str('%.2f')%self.iterationsSaved()+' skipped runs (alpha>=1): '+str(self.skipped)
+        if len(self.weightErrors)>0:
+            result += ' checked hits: '+str(len(self.weightErrors))+' weight error median/max: '+str('%.2e')%np.median(self.weightErrors)+'/'+str('%.2e')%np.max(self.weightErrors)
+        if len(self.distErrors)>0:
+            result += ' distance error median/max: '+str('%.2e')%np.median(self.distErrors)+'/'+str('%.2e')%np.max(self.distErrors)
+        return result
+
+def computeBetaCosts(costs, beta):
+    ids = costs.ids
+    weightedCost = {}
+    for i in range(len(ids)):
+        for j in range(len(ids)):
+            weightedCost[ids[i]+'_'+ids[j]] = math.exp(-1.0*beta*costs.costs[i,j])
+    return weightedCost
+
+def computeAlphaWeights(sites, alpha):
+    for site in sites:
+        site.weightAlpha = math.pow(site.weight, alpha)
+
+def runLoop(experiment, table, costs):
+    """
+    Original entropy iteration over Site objects. It is kept as a reference for MatrixEngine.
+    Final weights are copied back to the SiteTable
+    """
+    weightedCost = computeBetaCosts(costs, experiment.beta)
+    sites = [Site(table.ids[i], table.size[i], table.x[i], table.y[i], table.weight[i], table.isHarbour[i]) for i in range(len(table))]
 
     i = 0
 
-    maxIter = 5000
+    maxIter = experiment.maxIter
     maxIterOut = 10
     iterOut = 0
-    tolerance = 0.1
+    tolerance = experiment.tolerance
     test = tolerance
 
     while i<maxIter and iterOut<maxIterOut: 
@@ -208,13 +865,13 @@ def runEntropy(experiment, sites, storeResults):
         else:
             iterOut += 1
 
-        computeAlphaWeights(experiment.alpha)            
+        computeAlphaWeights(sites, experiment.alpha)            
 
         aggregatedFlow = 0
-        for site in Site.sites:
-            aggregatedFlow += site.computeFlow()
+        for site in sites:
+            aggregatedFlow += site.computeFlow(sites, weightedCost)
         aggregatedDiff = 0
-        for site in Site.sites:
+        for site in sites:
             aggregatedDiff += site.applyVariation(experiment.changeRate)
 
         test = aggregatedDiff/aggregatedFlow
@@ -222,13 +879,174 @@ def runEntropy(experiment, sites, storeResults):
         i += 1
   
 #    print('simulation finished after:',i,'steps')
+    table.weight = np.array([site.weight for site in sites])
+    return i
 
-    if(storeResults):
-        outputFile = open('output.csv','w')
-        outputFile.write('id;size;x;y;weight\n')
-        for site in Site.sites:
-            outputFile.write(site.ident+';'+str(site.size)+';'+str(site.x)+';'+str(site.y)+';'+'%.2f'%site.weight+'\n')
-        outputFile.close()
- 
-    return Site.sites 
-    
+class EntropyModel:
+    """
+    Entropy model holding its costs and sites as instance state.
+    Runs only share a per-thread kernel buffer, so the same model can be called from several threads at once
+
+    :param costs: datacache.CostMatrix (see loadCosts)
+    :param sitesFileName: path to the site table
+    """
+
+    def __init__(self, costs, sitesFileName):
+        self.costMatrix = costs
+        self.sitesFileName = sitesFileName
+        self.columns = datacache.loadSiteColumns(sitesFileName)
+        self.costs = alignedCosts(costs, [str(ident) for ident in self.columns.ids])
+        self._workspace = threading.local()
+        # rankCosts of the costs, computed by the first sparse run
+        self._ranking = None
+
+    def costRanking(self):
+        """
+        Returns rankCosts(self.costs), computed once and shared by the sparse kernels of all runs
+        """
+        if self._ranking is None:
+            self._ranking = rankCosts(self.costs)
+        return self._ranking
+
+    def computeKernel(self, beta):
+        """
+        Same as computeKernel, written into the kernel buffer of the calling thread
+        """
+        kernel = getattr(self._workspace, 'kernel', None)
+        if kernel is None:
+            kernel = np.empty(self.costs.shape)
+            self._workspace.kernel = kernel
+        np.multiply(self.costs, -1.0*beta, out=kernel)
+        np.exp(kernel, out=kernel)
+        np.fill_diagonal(kernel, 0)
+        return kernel
+
+    def runMatrix(self, experiment, sites, cache=None):
+        """
+        Entropy iteration computed with MatrixEngine. Final weights are copied back to the SiteTable
+
+        :param cache: (optional) EquilibriumCache used to warm start the iteration (see EquilibriumCache.accepts)
+        """
+        if experiment.kernelThreshold is None and experiment.kernelNeighbours is None:
+            kernel = self.computeKernel(experiment.beta)
+        else:
+            kernel, _ = computeSparseKernel(self.costs, experiment.beta, experiment.kernelThreshold, experiment.kernelNeighbours, self.costRanking())
+        weights = sites.weight
+
+        useCache = cache is not None and cache.accepts(experiment)
+        cached = None
+        if useCache:
+            theta = experiment.parameters()
+            cached = cache.lookup(theta)
+        if cached is not None:
+            # total weight is conserved by the iteration
+            weights = cached*np.sum(weights)/np.sum(cached)
+
+        engine = MatrixEngine(kernel, weights)
+        i = engine.run(experiment.alpha, experiment.changeRate, maxIter=experiment.maxIter, tolerance=experiment.tolerance,
+                       acceleration=experiment.acceleration)
+        experiment.accelerated = engine.accelerated
+        if useCache:
+            if cached is not None and cache.checkDue():
+                coldEngine = MatrixEngine(kernel, sites.weight)
+                coldEngine.run(experiment.alpha, experiment.changeRate, maxIter=experiment.maxIter, tolerance=experiment.tolerance,
+                               acceleration=experiment.acceleration)
+                cache.check(engine.weights, coldEngine.weights)
+            cache.store(theta, engine.weights, i, cached is not None)
+        sites.weight = engine.weights
+        return i
+
+    def run(self, experiment, storeResults=False, engine='matrix', cache=None, runId=None):
+        """
+        Runs one experiment
+
+        :param experiment: Experiment with the parameters of the run
+        :param storeResults: True to write the final weights to output.csv, or a sink (see sinks.NpzSink)
+        :param engine: 'matrix' (MatrixEngine) or 'loop' (runLoop)
+        :param cache: (optional) EquilibriumCache used to warm start the matrix engine
+        :param runId: (optional) key of the stored results in the sink
+
+        :returns sites: SiteTable with the final weights
+        """
+        sites = loadSites(self.sitesFileName, experiment.harbourBonus, experiment.weights)
+
+        # if any value is negative in particle then return max dist
+        if experiment.alpha < 0 or experiment.beta < 0:
+            print('returning 1 because:',experiment.alpha, experiment.beta)
+            sites.weight[:] = -1
+            return sites
+
+        if engine=='matrix':
+            experiment.iterations = self.runMatrix(experiment, sites, cache)
+        elif engine=='loop':
+            experiment.iterations = runLoop(experiment, sites, self.costMatrix)
+            experiment.accelerated = False
+        else:
+            raise ValueError('unknown engine: '+str(engine))
+
+        sink = sinks.getSink(storeResults, {'weight': '%.2f'})
+        if sink is not None:
+            sink.write(runId, {'id': sites.ids, 'size': sites.size, 'x': sites.x, 'y': sites.y, 'weight': sites.weight})
+
+        return sites
+
+    def runBatch(self, thetas, weights=None, changeRate=0.1, slots=None):
+        """
+        Runs the entropy model for several parameter sets at once
+
+        :param thetas: K x 3 array of (alpha, beta, harbourBonus)
+        :param weights: (optional) initial weights, either one vector of N weights or K x N
+        :param changeRate: rate of the weight update
+        :param slots: (optional) number of members iterated at once by BatchEngine (default batchSlots(N), memory is slots*N*N)
+
+        :returns weights, iterations: K x N final weights (-1 for invalid parameter sets) and iterations of each member
+        """
+        thetas = np.atleast_2d(np.asarray(thetas, dtype=float))
+
+        numRuns = len(thetas)
+        initialWeights = np.ones([numRuns, len(self.columns.ids)])
+        if weights is not None:
+            initialWeights *= weights
+        initialWeights *= 1+thetas[:,2,None]*self.columns.isHarbour
+
+        result = np.full(initialWeights.shape, -1.0)
+        iterations = np.zeros(numRuns, dtype=int)
+
+        # if any value is negative in particle then return max dist
+        valid = np.flatnonzero(np.logical_and(thetas[:,0]>=0, thetas[:,1]>=0))
+        if len(valid)>0:
+            engine = BatchEngine(self.costs, thetas[valid,1], initialWeights[valid], slots)
+            iterations[valid] = engine.run(thetas[valid,0], changeRate)
+            result[valid] = engine.weights
+        return result, iterations
+
+    def approximationError(self, experiment):
+        """
+        Compares the sparse kernel of the experiment with the dense one. Both runs start from the initial weights
+
+        :returns error, droppedMass: relative L1 difference of the final weights and fraction of the kernel mass dropped
+        """
+        sparseExperiment = copy.copy(experiment)
+        sparseResult = self.run(sparseExperiment)
+
+        denseExperiment = copy.copy(experiment)
+        denseExperiment.kernelThreshold = None
+        denseExperiment.kernelNeighbours = None
+        denseResult = self.run(denseExperiment)
+
+        error = np.sum(np.absolute(sparseResult.weight-denseResult.weight))/np.sum(denseResult.weight)
+        _, experiment.droppedMass = computeSparseKernel(self.costs, experiment.beta, experiment.kernelThreshold, experiment.kernelNeighbours,
+                                                        self.costRanking(), computeMass=True)
+        return error, experiment.droppedMass
+
+def runEntropy(experiment, sites, storeResults, engine='matrix', cache=None, runId=None):
+    """
+    Runs one experiment with the cost matrix loaded by loadCosts. See EntropyModel.run
+    """
+    return EntropyModel(_costs, sites).run(experiment, storeResults, engine, cache, runId)
+
+def runEntropyBatch(thetas, sites, weights=None, changeRate=0.1, slots=None):
+    """
+    Runs several parameter sets with the cost matrix loaded by loadCosts. See EntropyModel.runBatch
+    """
+    return EntropyModel(_costs, sites).runBatch(thetas, weights, changeRate, slots)
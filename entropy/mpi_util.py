@@ -11,7 +11,10 @@
 # You should have received a copy of the GNU General Public License
 # along with abcpmc.  If not, see <http://www.gnu.org/licenses/>.
 
+import io
 import itertools
+import pickle
+import traceback
 
 try:
     from mpi4py import MPI
@@ -19,7 +22,15 @@ try:
 except ImportError:
     MPI = None
 
-__all__ = ["MpiPool", "mpiBCast"]
+__all__ = ["MpiPool", "MpiWorkerPool", "mpiBCast"]
+
+# message tags of MpiWorkerPool
+_TAG_TASK = 1
+_TAG_FUNCTION = 2
+_TAG_RESULT = 3
+_TAG_ERROR = 4
+_TAG_EXIT = 5
+_TAG_SHARE = 6
 
 class MpiPool(object):
     def __init__(self, mapFunction=map):
@@ -39,6 +50,223 @@ class MpiPool(object):
         """
         return (self.rank==0)
     
+class _Pickler(pickle.Pickler):
+    # replaces the shared objects by their key
+    def __init__(self, file, shared, buffer_callback):
+        pickle.Pickler.__init__(self, file, protocol=5, buffer_callback=buffer_callback)
+        self.shared = shared
+    
+    def persistent_id(self, obj):
+        return self.shared.get(id(obj))
+
+class _Unpickler(pickle.Unpickler):
+    def __init__(self, file, shared, buffers):
+        pickle.Unpickler.__init__(self, file, buffers=buffers)
+        self.shared = shared
+    
+    def persistent_load(self, key):
+        return self.shared[key]
+
+class MpiWorkerPool(object):
+    """
+    Master/worker pool: rank 0 hands out the items one at a time to the free workers and collects the results 
+    as they finish, so fast and slow tasks do not wait for each other. 
+    The other ranks have to call wait() to serve tasks until the master calls close(), e.g.
+    
+        pool = MpiWorkerPool()
+        if not pool.isMaster():
+            pool.wait()
+            sys.exit(0)
+        sampler = Sampler(..., pool=pool)
+        ...
+        pool.close()
+    
+    It can be tested on one machine with mpirun -n 4 python script.py. With a single rank the master runs the tasks itself.
+    
+    In hybrid mode there is one rank per node, and each worker runs up to slots tasks at once with the map function of a 
+    local pool given to wait(), e.g. pool.wait(multiprocessing.Pool(16).map) with slots=16. 
+    
+    The function of each map call is broadcast once to all the workers, pickled with protocol 5 so that large arrays
+    (e.g. the previous population) are sent as raw buffers with Bcast. Objects registered with share() are sent once per run
+    and replaced by a key when pickling the functions. Items and results are sent with each task
+    
+    :param comm: (optional) communicator, MPI.COMM_WORLD by default
+    :param slots: (optional) number of tasks this rank runs at once (size of its local pool). All ranks have to create the
+        pool together, as the slots of the workers are gathered on the master
+    """
+    
+    # arrays smaller than this are pickled in-band
+    minBufferSize = 4096
+    
+    def __init__(self, comm=None, slots=1):
+        self.comm = comm if comm is not None else MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+        self.workers = list(range(1, self.size))
+        # tasks run at once by each worker, and in total
+        self._slots = self.comm.gather(slots, root=0)
+        self.slots = sum(self._slots[1:]) if self.isMaster() and self.workers else slots
+        self._functionId = 0
+        # workers with a running task
+        self._busy = set()
+        # id of the shared objects -> key (master), key -> object (workers)
+        self._sharedIds = {}
+        self._shared = {}
+        self._objects = []
+        # bytes broadcast to the workers
+        self.sentBytes = 0
+    
+    def isMaster(self):
+        """
+        Returns true if the rank is 0
+        """
+        return (self.rank==0)
+    
+    def share(self, obj):
+        """
+        Sends a static object (e.g. the observed data) to the workers once. It is not sent again inside the functions
+        """
+        if id(obj) in self._sharedIds:
+            return
+        key = len(self._objects)
+        self._broadcast(_TAG_SHARE, (key, obj))
+        self._objects.append(obj)
+        self._sharedIds[id(obj)] = key
+    
+    def wait(self, mapFunction=map):
+        """
+        Runs the tasks sent by the master until close() is called (workers only)
+        
+        :param mapFunction: (optional) map function used to run the tasks received at once, e.g. the map of a local pool
+        """
+        status = MPI.Status()
+        function = None
+        functionId = None
+        while True:
+            message = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+            tag = status.Get_tag()
+            if tag == _TAG_EXIT:
+                break
+            if tag == _TAG_SHARE:
+                key, obj = self._receiveBroadcast()
+                self._shared[key] = obj
+                continue
+            if tag == _TAG_FUNCTION:
+                functionId, function = message, self._receiveBroadcast()
+                continue
+            js, items = message
+            try:
+                self.comm.send((functionId, js, list(mapFunction(function, items))), dest=0, tag=_TAG_RESULT)
+            except Exception:
+                self.comm.send((functionId, js, traceback.format_exc()), dest=0, tag=_TAG_ERROR)
+    
+    def map(self, function, sequence):
+        """
+        Applies the function to each item of the sequence on the workers
+        
+        :returns results: list of the results in the order of the sequence
+        """
+        sequence = list(sequence)
+        results = [None]*len(sequence)
+        for j, result in self._imap(function, sequence):
+            results[j] = result
+        return results
+    
+    def imap_unordered(self, function, iterable):
+        """
+        Applies the function to each item on the workers and yields the results as they finish. 
+        Items are taken from the iterable only when a worker is free. If the iteration is stopped early, the running
+        tasks finish on the workers and their results are dropped
+        """
+        for _, result in self._imap(function, iterable):
+            yield result
+    
+    def close(self):
+        """
+        Waits for the running tasks and stops the workers
+        """
+        self._drain()
+        for worker in self.workers:
+            self.comm.send(None, dest=worker, tag=_TAG_EXIT)
+        self.workers = []
+    
+    def _drain(self):
+        # drops the results of the tasks of a stopped iteration
+        status = MPI.Status()
+        while self._busy:
+            self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            self._busy.discard(status.Get_source())
+    
+    def _broadcast(self, tag, obj):
+        # all the workers have to be waiting for a message before the collective calls
+        if not self.workers:
+            return
+        self._drain()
+        buffers = []
+        def callback(buffer):
+            if buffer.raw().nbytes < self.minBufferSize:
+                return True
+            buffers.append(buffer.raw())
+        data = io.BytesIO()
+        _Pickler(data, self._sharedIds, callback).dump(obj)
+        data = data.getvalue()
+        
+        for worker in self.workers:
+            self.comm.send(self._functionId, dest=worker, tag=tag)
+        self.comm.bcast((data, [buffer.nbytes for buffer in buffers]), root=0)
+        for buffer in buffers:
+            self.comm.Bcast([buffer, MPI.BYTE], root=0)
+        self.sentBytes += len(data) + sum(buffer.nbytes for buffer in buffers)
+    
+    def _receiveBroadcast(self):
+        data, sizes = self.comm.bcast(None, root=0)
+        buffers = [bytearray(size) for size in sizes]
+        for buffer in buffers:
+            self.comm.Bcast([buffer, MPI.BYTE], root=0)
+        return _Unpickler(io.BytesIO(data), self._shared, buffers).load()
+    
+    def _imap(self, function, iterable):
+        if not self.workers:
+            for j, item in enumerate(iterable):
+                yield j, function(item)
+            return
+        
+        self._functionId += 1
+        functionId = self._functionId
+        self._broadcast(_TAG_FUNCTION, function)
+        items = enumerate(iterable)
+        free = list(self.workers)
+        pending = 0
+        exhausted = False
+        status = MPI.Status()
+        
+        while True:
+            while free and not exhausted:
+                # as many items as the worker runs at once
+                task = list(itertools.islice(items, self._slots[free[-1]]))
+                if len(task) == 0:
+                    exhausted = True
+                    break
+                worker = free.pop()
+                self.comm.send(tuple(zip(*task)), dest=worker, tag=_TAG_TASK)
+                self._busy.add(worker)
+                pending += len(task)
+            if pending == 0 and exhausted:
+                return
+            
+            resultId, js, results = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            worker = status.Get_source()
+            self._busy.discard(worker)
+            free.append(worker)
+            if resultId != functionId:
+                # result of an earlier call which was stopped early
+                continue
+            pending -= len(js)
+            if status.Get_tag() == _TAG_ERROR:
+                raise RuntimeError("task failed on rank %d:\n%s" % (worker, results))
+            for j, result in zip(js, results):
+                yield j, result
+
 def mpiBCast(value):
     """
     Mpi bcasts the value and returns the value from the master (rank = 0).
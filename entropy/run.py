@@ -20,7 +20,7 @@ def singleRun():
     experiment = entropy.Experiment(0,alpha,beta,harbourBonus, None)
     result = entropy.runEntropy(experiment, sites, True)
 
-    dist = entropy.distAbs(data, result)
+    dist = entropy.distAbs(data, result, verbose=True)
 
 if __name__ == "__main__":
     singleRun()
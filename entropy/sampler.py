@@ -19,12 +19,16 @@ author: jakeret
 '''
 from __future__ import print_function, division, absolute_import, unicode_literals
 
-from multiprocessing.pool import Pool
+from multiprocessing.pool import Pool, ThreadPool
 from collections import namedtuple
+import threading
 
 import numpy as np
 from scipy import stats
 from scipy import spatial
+from scipy import linalg
+from scipy import special
+import copy
 import os
 import entropy
 
@@ -35,6 +39,7 @@ __all__ = ["GaussianPrior",
            "OLCMParticleProposal", 
            "Sampler", 
            "weighted_cov", 
+           "importance_weights", 
            "weighted_avg_and_std"
            ]
 
@@ -56,6 +61,12 @@ class GaussianPrior(object):
             return self._random.multivariate_normal(self.mu, self.sigma)
         else:
             return stats.multivariate_normal.pdf(theta, self.mu, self.sigma)
+    
+    def sample(self, size):
+        """
+        Draws a block of size thetas
+        """
+        return self._random.multivariate_normal(self.mu, self.sigma, size)
 
 
 class TophatPrior(object):
@@ -78,6 +89,52 @@ class TophatPrior(object):
             return np.array([self._random.uniform(mi, ma) for (mi, ma) in zip(self.min, self.max)])
         else:
             return 1 if np.all(theta < self.max) and np.all(theta >= self.min) else 0
+    
+    def sample(self, size):
+        """
+        Draws a block of size thetas
+        """
+        return self._random.uniform(self.min, self.max, (size, len(self.min)))
+
+def _log_accepted(i, eps, thetap, p, X, cnt):
+    logFile = open('particle_'+str(i)+'_eps_'+str('%.2f')%eps+'.txt', 'a')
+    logFile.write('ok! i:'+str(i)+' - eps: '+str('%.2f')%eps+' - thetas: '+str(thetap)+' - dist: '+str(p)+'\n')
+    if hasattr(X, 'initialWeight'):
+        initialWeights = list(X.initialWeight)
+        logFile.write('initial weights: '+str(initialWeights)+'\n')
+    else:
+        # batch models return the final weights
+        logFile.write('weights: '+str(X)+'\n')
+    logFile.write('prevSims:'+str(cnt)+'\n')
+    logFile.close()
+
+def _within(ps, eps):
+    # acceptance of each row of a block of distances
+    return np.all(ps <= eps, axis=tuple(range(1, ps.ndim)))
+
+def _worker_id():
+    return "%d-%s" % (os.getpid(), threading.current_thread().name)
+
+class _BatchEvaluator(object):  # @DontTrace
+    """
+    Runs the model and the distance on a block of thetas. Uses postfn.batch(thetas) and dist.batch(X) if they exist,
+    otherwise calls postfn and dist on each theta (adapter for scalar models).
+    Allows for pickling the functionality.
+    """
+    
+    def __init__(self, postfn, dist, Y):
+        self.postfn = postfn
+        self.dist = dist
+        self.Y = Y
+    
+    def __call__(self, thetas):
+        if hasattr(self.postfn, "batch"):
+            X = self.postfn.batch(thetas)
+            if hasattr(self.dist, "batch"):
+                return X, np.asarray(self.dist.batch(X))
+        else:
+            X = [self.postfn(theta) for theta in thetas]
+        return X, np.array([np.asarray(self.dist(x, self.Y)) for x in X])
 
 class ParticleProposal(object):
     """
@@ -94,11 +151,20 @@ class ParticleProposal(object):
         self.kwargs = kwargs
         
         self.sigma = 2 * weighted_cov(pool.thetas, pool.ws)
+        self.sigma_sqrt = _sqrt_cov(self.sigma)
+        
+        self.batchSize = sampler.batchSize
+        self.evaluate = _BatchEvaluator(sampler.postfn, sampler.dist, sampler.Y)
+        if self.batchSize:
+            # blocks of about the expected number of attempts per particle of the previous generation
+            self.blockSize = int(min(self.batchSize, max(1, np.ceil(1.0/pool.ratio))))
     
     def __call__(self, i):
+        if self.batchSize:
+            return self._call_batch(i)
         cnt = 1
-        # setting seed to prevent problem with multiprocessing
-        self._random.seed(i)  
+        # one random state per particle to prevent problems with multiprocessing and threads
+        random = np.random.mtrand.RandomState(i)
 #        logFile = open('particle_'+str(i)+'_eps_'+str('%.2f')%self.eps+'.txt', 'a')
 #        logFile.write('starting sample\n')
 #        logFile.close()
@@ -107,16 +173,14 @@ class ParticleProposal(object):
 #            logFile.write('starting selection between '+str(self.N)+' particles\n')
 #            for j in range(len(self.pool.ws)):
 #                logFile.write('particle: '+str(j)+' thetas: '+str(self.pool.thetas[j])+' have weight: '+str(self.pool.ws[j])+'\n')
-            idx = self._random.choice(range(self.N), 1, p= self.pool.ws/np.sum(self.pool.ws))[0]
+            idx = random.choice(range(self.N), 1, p= self.pool.ws/np.sum(self.pool.ws))[0]
             theta = self.pool.thetas[idx]
 #            logFile.write('idx chosen: '+str(idx)+' with thetas: '+str(theta)+'\n')
 #            logFile.close()
 
-            sigma = self._get_sigma(theta, **self.kwargs)
-            sigma = np.atleast_2d(sigma)
-            thetap = self._random.multivariate_normal(theta, sigma)
+            thetap = self._propose(idx, theta, random)
             while (thetap<0).any():
-                thetap = self._random.multivariate_normal(theta, sigma)
+                thetap = self._propose(idx, theta, random)
                     
 #            logFile = open('particle_'+str(i)+'_eps_'+str('%.2f')%self.eps+'.txt', 'a')
 #            logFile.write('\texecuting run with new thetap:'+str(thetap)+'\n')
@@ -126,12 +190,7 @@ class ParticleProposal(object):
             p = np.asarray(self.distfn(X, self.Y))
             
             if np.all(p <= self.eps):
-                logFile = open('particle_'+str(i)+'_eps_'+str('%.2f')%self.eps+'.txt', 'a')
-                logFile.write('ok! i:'+str(i)+' - eps: '+str('%.2f')%self.eps+' - thetas: '+str(thetap)+' - dist: '+str(p)+'\n')
-                initialWeights = [site.initialWeight for site in X]
-                logFile.write('initial weights: '+str(initialWeights)+'\n')
-                logFile.write('prevSims:'+str(cnt)+'\n')
-                logFile.close()
+                _log_accepted(i, self.eps, thetap, p, X, cnt)
                 break
 
 #            logFile = open('particle_'+str(i)+'_eps_'+str('%.2f')%self.eps+'.txt', 'a')
@@ -140,27 +199,99 @@ class ParticleProposal(object):
             cnt+=1
         return thetap, p, cnt
 
+    def _call_batch(self, i):
+        # same as __call__ but drawing and evaluating blocks of candidates. The first accepted candidate of a block
+        # is returned, so the particle and its count are those of sequential rejection sampling
+        cnt = 0
+        random = np.random.mtrand.RandomState(i)
+        while True:
+            thetaps = self._draw(random, self.blockSize)
+            Xs, ps = self.evaluate(thetaps)
+            accepted = np.flatnonzero(_within(ps, self.eps))
+            if len(accepted) > 0:
+                j = accepted[0]
+                cnt += j+1
+                _log_accepted(i, self.eps, thetaps[j], ps[j], Xs[j], cnt)
+                return thetaps[j], ps[j], cnt
+            cnt += len(thetaps)
+
+    def attempts(self, seed, size):
+        """
+        Runs size simulation attempts (used by the dynamic scheduler of the Sampler)
+        
+        :returns accepted: list of (position, theta, dist) of the accepted attempts
+        """
+        thetaps = self._draw(np.random.mtrand.RandomState(seed), size)
+        _, ps = self.evaluate(thetaps)
+        return [(j, thetaps[j], ps[j]) for j in np.flatnonzero(_within(ps, self.eps))]
+
+    def _draw(self, random, size):
+        # ancestors, perturbation and resampling of negative thetas for a block of candidates
+        idxs = random.choice(self.N, size, p=self.pool.ws/np.sum(self.pool.ws))
+        thetaps = self._propose_block(idxs, random)
+        invalid = (thetaps<0).any(axis=1)
+        while invalid.any():
+            thetaps[invalid] = self._propose_block(idxs[invalid], random)
+            invalid = (thetaps<0).any(axis=1)
+        return thetaps
+
     def _get_sigma(self, theta):
         return self.sigma
 
+    def _propose(self, idx, theta, random):
+        sigma = np.atleast_2d(self._get_sigma(theta, **self.kwargs))
+        return random.multivariate_normal(theta, sigma)
+
+    def _propose_block(self, idxs, random):
+        thetas = self.pool.thetas[idxs]
+        return thetas + np.dot(random.standard_normal(thetas.shape), self.sigma_sqrt.T)
+
 class KNNParticleProposal(ParticleProposal):
     """
     Creates new particles using a covariance matrix from the K-nearest neighbours  (Fillipi et al. 2012)
     Set `k` as key-word arguement in `abcpmc.Sampler.particle_proposal_kwargs`
+    
+    The tree, the neighbours and the square root of the covariance of all particles are computed once per generation,
+    and are sent to the workers with the proposal
     """
     
+    def __init__(self, sampler, eps, pool, kwargs):
+        super(KNNParticleProposal, self).__init__(sampler, eps, pool, kwargs)
+        self.tree = spatial.cKDTree(self.pool.thetas)
+        _, self.neighbours = self.tree.query(self.pool.thetas, kwargs["k"], p=2)
+        # covariance of the neighbours of each ancestor, as np.cov
+        diff = self.pool.thetas[self.neighbours]
+        diff = diff - np.mean(diff, axis=1, keepdims=True)
+        sigmas = np.einsum('nki,nkj->nij', diff, diff) / (diff.shape[1] - 1)
+        try:
+            self.cov_sqrts = np.linalg.cholesky(sigmas)
+        except np.linalg.LinAlgError:
+            self.cov_sqrts = np.array([_sqrt_cov(sigma) for sigma in sigmas])
+    
     def _get_sigma(self, theta, k):
-        tree = spatial.cKDTree(self.pool.thetas)
-        _, idxs = tree.query(theta, k, p=2)
+        _, idxs = self.tree.query(theta, k, p=2)
         sigma = np.cov(self.pool.thetas[idxs].T)
         return sigma
+    
+    def _propose(self, idx, theta, random):
+        L = self.cov_sqrts[idx]
+        return theta + np.dot(L, random.standard_normal(L.shape[1]))
+    
+    def _propose_block(self, idxs, random):
+        z = random.standard_normal((len(idxs), self.cov_sqrts.shape[2]))
+        return self.pool.thetas[idxs] + np.einsum('nij,nj->ni', self.cov_sqrts[idxs], z)
 
 class OLCMParticleProposal(ParticleProposal):
     """
     Creates new particles using an optimal loacl covariance matrix (Fillipi et al. 2012)
+    
+    The covariance for an ancestor theta is C + (m - theta)(m - theta)^T, where m and C are the weighted mean and 
+    covariance of the particles below eps. m, C and the square root of C are computed once per generation and
+    the theta dependent term is sampled as a rank-one correction
     """
     
-    def _get_sigma(self, theta):
+    def __init__(self, sampler, eps, pool, kwargs):
+        super(OLCMParticleProposal, self).__init__(sampler, eps, pool, kwargs)
         if len(self.eps.shape) == 0:
             idx = self.pool.dists < self.eps
         else:
@@ -169,14 +300,24 @@ class OLCMParticleProposal(ParticleProposal):
         weights = self.pool.ws[idx]
         weights = weights/np.sum(weights)
         
-        m = np.sum((weights * thetas.T).T, axis=0)
-        n = thetas.shape[1]
-        
-        sigma = np.empty((n, n))
-        for i in range(n):
-            for j in range(n):
-                sigma[i, j] = np.sum(weights * (thetas[:, i] - m[i]) * (thetas[:, j] - m[j]).T)  + (m[i] - theta[i]) * (m[j] - theta[j])
-        return sigma
+        self.m = np.dot(weights, thetas)
+        diff = thetas - self.m
+        self.cov = np.dot((weights * diff.T), diff)
+        self.cov_sqrt = _sqrt_cov(self.cov)
+    
+    def _get_sigma(self, theta):
+        d = self.m - theta
+        return self.cov + np.outer(d, d)
+    
+    def _propose(self, idx, theta, random):
+        # theta + L z1 + (m - theta) z2 has covariance L L^T + (m - theta)(m - theta)^T
+        z = random.standard_normal(self.cov_sqrt.shape[1])
+        return theta + np.dot(self.cov_sqrt, z) + (self.m - theta) * random.standard_normal()
+    
+    def _propose_block(self, idxs, random):
+        thetas = self.pool.thetas[idxs]
+        z = random.standard_normal((len(idxs), self.cov_sqrt.shape[1]))
+        return thetas + np.dot(z, self.cov_sqrt.T) + (self.m - thetas) * random.standard_normal((len(idxs), 1))
 
 
 """Namedtuple representing a pool of one sampling iteration"""
@@ -190,72 +331,188 @@ class Sampler(object):
     :param Y: observed data set
     :param postfn: model function (a callable), which creates a new dataset x for a given theta
     :param dist: distance function rho(X, Y) (a callable)
-    :param threads: (optional) number of threads. If >1 and no pool is given <threads> multiprocesses will be started
+    :param threads: (optional) number of threads. If >1 and no pool is given <threads> workers will be started
     :param pool: (optional) a pool instance which has a <map> function 
+    :param executor: (optional) 'process' to start the workers as processes or 'thread' to use threads within this process
+        (postfn must be thread-safe, e.g. entropy.EntropyModel)
+    :param batchSize: (optional) if set, the workers draw and evaluate blocks of up to batchSize candidates. postfn and dist
+        are called on a whole block if they have a batch method (postfn.batch(thetas), dist.batch(X)), otherwise on each candidate
+    :param scheduler: (optional) 'static' runs one task per particle. 'dynamic' submits chunks of chunkSize attempts as workers
+        become free (at most maxInFlight at a time) and stops once N particles are accepted. The pool needs imap_unordered
+        (multiprocessing pools and mpi_util.MpiWorkerPool). Particles are accepted in 
+        submission order, so fast simulations are not favoured. The attempts of each worker are kept in workerAttempts
+    :param chunkSize: (optional) number of simulation attempts per task of the dynamic scheduler (batchSize if set)
+    :param maxInFlight: (optional) maximum number of submitted tasks of the dynamic scheduler (default 4 per worker: per
+        process of a multiprocessing pool or per slot of an mpi_util.MpiWorkerPool). It has to be at least the number of tasks
+        the pool runs at once, and is required with the dynamic scheduler for other pools
     """
     
     particle_proposal_cls = OLCMParticleProposal
     particle_proposal_kwargs = {}
     
-    def __init__(self, N, Y, postfn, dist, threads=1, pool=None):
+    def __init__(self, N, Y, postfn, dist, threads=1, pool=None, executor='process', batchSize=None,
+                 scheduler='static', chunkSize=8, maxInFlight=None):
         self.N = N
         self.Y = Y
         self.postfn = postfn
         self.dist = dist
+        self.batchSize = batchSize
         self._random = np.random.mtrand.RandomState()
+        
+        if scheduler not in ('static', 'dynamic'):
+            raise ValueError('unknown scheduler: '+str(scheduler))
+        if scheduler == 'dynamic' and pool is not None and not hasattr(pool, "imap_unordered"):
+            raise ValueError('the dynamic scheduler needs a pool with imap_unordered')
+        self.scheduler = scheduler
+        self.chunkSize = batchSize or chunkSize
+        self.maxInFlight = maxInFlight
+        if maxInFlight is None:
+            workers = threads if pool is None else getattr(pool, "slots", getattr(pool, "_processes", None))
+            if workers is None and scheduler == 'dynamic':
+                raise ValueError('maxInFlight is required when the number of workers of the pool is unknown')
+            self.maxInFlight = 4*(workers or 1)
+        self.workerAttempts = {}
 
         if pool is not None:
             self.pool = pool
             self.mapFunc  = self.pool.map
+            if hasattr(self.pool, "share"):
+                # static data is sent to the workers once instead of with each generation
+                self.pool.share(Y)
+                self.pool.share(dist)
+                self.pool.share(self._random)
             
         elif threads == 1:
             self.mapFunc = map
+        elif executor == 'thread':
+            self.pool = ThreadPool(threads)
+            self.mapFunc  = self.pool.map
         else:
             self.pool = Pool(threads)
             self.mapFunc  = self.pool.map
             
     
-    def sample(self, prior, eps_proposal):
+    def sample(self, prior, eps_proposal, store=None, resume=False):
         """
         Launches the sampling process. Yields the intermediate results per iteration.
         
         :param prior: instance of a prior definition (or an other callable)  see :py:class:`sampler.GaussianPrior`
-        :param eps_proposal: an instance of a threshold proposal (or an other callable) see :py:class:`sampler.ConstEps`
+        :param eps_proposal: an instance of a threshold proposal (or an other callable) see :py:class:`sampler.ConstEps`.
+            If it has an update method, it is called with each population before the next epsilon is drawn (see threshold.AdaptiveEps)
+        :param store: (optional) store.PopulationStore where each generation is written before it is yielded
+        :param resume: (optional) continue after the last generation of the store instead of starting from the prior. 
+            The stored generations are not yielded again. Without resume the store must be empty.
+            The global numpy generator (np.random, drawn by the models) is restored to its state after the last
+            stored generation. The generators of worker processes are not stored, so only runs that simulate in
+            this process (threads=1 or the thread executor) continue exactly like an uninterrupted run
         
         :yields pool: yields a namedtuple representing the values of one iteration
         """
         
-        eps = eps_proposal.next()
-
-        wrapper = _RejectionSamplingWrapper(self, eps, prior)
-        
-        res = list(self.mapFunc(wrapper, range(self.N)))
-        thetas = np.array([theta for (theta, _, _) in res])
-        dists = np.array([dist for (_, dist, _) in res])
-        cnts = np.sum([cnt for (_, _, cnt) in res])
-        ws = np.ones(self.N) / self.N
+        if not resume and store is not None and len(store) > 0:
+            raise ValueError('the store %s already has generations, use resume=True to continue the run' % store.directory)
         
-        pool = PoolSpec(0, eps, self.N/cnts, thetas, dists, ws)
-        yield pool
+        if resume and store is not None and len(store) > 0:
+            pool = self._restore(store, eps_proposal)
+        else:
+            eps = eps_proposal.next()
+
+            wrapper = _RejectionSamplingWrapper(self, eps, prior)
+            
+            thetas, dists, cnts = self._run_generation(wrapper, 0)
+            ws = np.ones(self.N) / self.N
+            
+            pool = PoolSpec(0, eps, self.N/cnts, thetas, dists, ws)
+            if store is not None:
+                store.append(pool, cnts, self.workerAttempts, np.random.get_state())
+            yield pool
+            if hasattr(eps_proposal, "update"):
+                eps_proposal.update(pool)
         
-        for t, eps in enumerate(eps_proposal, 1):
+        for t, eps in enumerate(eps_proposal, pool.t + 1):
             particleProposal = self.particle_proposal_cls(self, eps, pool, self.particle_proposal_kwargs)
             
-            res = list(self.mapFunc(particleProposal, range(self.N)))
-            thetas = np.array([theta for (theta, _, _) in res])
-            dists = np.array([dist for (_, dist, _) in res]) 
-            cnts = np.sum([cnt for (_, _, cnt) in res])
+            thetas, dists, cnts = self._run_generation(particleProposal, t)
             
             sigma = 2 * weighted_cov(pool.thetas, pool.ws)
-            wrapper = _WeightWrapper(prior, sigma, pool.ws, pool.thetas)
-            
-            wt = np.array(list(self.mapFunc(wrapper, thetas)))
-            ws = wt/np.sum(wt)
+            ws = importance_weights(prior, sigma, pool.ws, pool.thetas, thetas)
             
             pool = PoolSpec(t, eps, self.N/cnts, thetas, dists, ws)
+            if store is not None:
+                store.append(pool, cnts, self.workerAttempts, np.random.get_state())
             yield pool
+            if hasattr(eps_proposal, "update"):
+                eps_proposal.update(pool)
+    
+    def _restore(self, store, eps_proposal):
+        # replays the threshold schedule over the stored generations and returns the last one
+        for t in store.generations():
+            pool = store.load(t, mmap=False)
+            eps_proposal.next()
+            if hasattr(eps_proposal, "update"):
+                eps_proposal.update(pool)
+        state = store.randomState(pool.t)
+        if state is not None:
+            np.random.set_state(state)
+        return pool
             
-            
+    def _run_generation(self, proposal, t):
+        # returns the accepted thetas and dists, and the total number of attempts
+        if self.scheduler == 'dynamic':
+            return self._schedule(proposal, t)
+        res = list(self.mapFunc(proposal, range(self.N)))
+        thetas = np.array([theta for (theta, _, _) in res])
+        dists = np.array([dist for (_, dist, _) in res])
+        cnts = np.sum([cnt for (_, _, cnt) in res])
+        return thetas, dists, cnts
+    
+    def _schedule(self, proposal, t):
+        # without a pool (threads=1) the chunks run in this process, other pools are checked in __init__
+        imapFunc = getattr(getattr(self, "pool", None), "imap_unordered", map)
+        
+        # tasks are only generated when a slot is free, and no more once N particles are accepted
+        slots = threading.Semaphore(self.maxInFlight)
+        stop = threading.Event()
+        def tasks():
+            j = 0
+            while True:
+                slots.acquire()
+                if stop.is_set():
+                    return
+                yield j, [t, j], self.chunkSize
+                j += 1
+        
+        # results of the tasks which are not yet part of the completed prefix
+        done = {}
+        nextTask = 0
+        accepted = []
+        cnts = 0
+        self.workerAttempts = {}
+        try:
+            for j, res, size, worker in imapFunc(_AttemptsWrapper(proposal), tasks()):
+                self.workerAttempts[worker] = self.workerAttempts.get(worker, 0) + size
+                done[j] = (res, size)
+                # accept in submission order, as sequential rejection sampling would
+                while nextTask in done and len(accepted) < self.N:
+                    res, size = done.pop(nextTask)
+                    for pos, theta, p in res[:self.N - len(accepted)]:
+                        accepted.append((theta, p))
+                        last = pos + 1
+                    cnts += size if len(accepted) < self.N else last
+                    nextTask += 1
+                if len(accepted) >= self.N:
+                    # outstanding tasks finish on the workers but are ignored
+                    break
+                slots.release()
+        finally:
+            # stops the task generator, also if a task failed, so that the pool does not wait for a slot forever
+            stop.set()
+            slots.release()
+        
+        thetas = np.array([theta for (theta, _) in accepted])
+        dists = np.array([p for (_, p) in accepted])
+        return thetas, dists, cnts
+    
     def close(self):
         """
         Tries to close the pool (avoid hanging threads)
@@ -264,23 +521,6 @@ class Sampler(object):
             self.pool.close()
 
    
-class _WeightWrapper(object):  # @DontTrace
-    """
-    Wraps the computation of new particle weights.
-    Allows for pickling the functionality.
-    """
-    
-    def __init__(self, prior, sigma, ws, thetas):
-        self.prior = prior
-        self.sigma = sigma
-        self.ws = ws
-        self.thetas = thetas
-    
-    def __call__(self, theta):
-        kernel = stats.multivariate_normal(theta, self.sigma, allow_singular=True).pdf
-        w = self.prior(theta) / np.sum(self.ws * kernel(self.thetas))
-        return w
-    
 class _RejectionSamplingWrapper(object):  # @DontTrace
     """
     Wraps the computation of new particles in the first iteration (simple rejection sampling).
@@ -294,21 +534,69 @@ class _RejectionSamplingWrapper(object):  # @DontTrace
         self.Y = sampler.Y
         self.eps = np.asarray(eps)
         self.prior = prior
+        self.batchSize = sampler.batchSize
+        self.evaluate = _BatchEvaluator(sampler.postfn, sampler.dist, sampler.Y)
     
     def __call__(self, i):
         cnt = 1
-        try: # setting seed to prevent problem with multiprocessing 
-            self._random.seed(i)
-            self.prior._random = self._random 
+        # one random state per particle to prevent problems with multiprocessing and threads
+        prior = copy.copy(self.prior)
+        try:
+            prior._random = np.random.mtrand.RandomState(i)
         except: pass
+        if self.batchSize:
+            return self._call_batch(prior)
         while True:
-            thetai = self.prior()
+            thetai = prior()
             X = self.postfn(thetai)
             p = np.asarray(self.distfn(X, self.Y))
             if np.all(p <= self.eps):
                 break
             cnt+=1
         return thetai, p, cnt
+    
+    def _call_batch(self, prior):
+        cnt = 0
+        while True:
+            thetas = self._draw(prior, self.batchSize)
+            Xs, ps = self.evaluate(thetas)
+            accepted = np.flatnonzero(_within(ps, self.eps))
+            if len(accepted) > 0:
+                j = accepted[0]
+                return thetas[j], ps[j], cnt+j+1
+            cnt += len(thetas)
+    
+    def attempts(self, seed, size):
+        """
+        Runs size simulation attempts (used by the dynamic scheduler of the Sampler)
+        
+        :returns accepted: list of (position, theta, dist) of the accepted attempts
+        """
+        prior = copy.copy(self.prior)
+        try:
+            prior._random = np.random.mtrand.RandomState(seed)
+        except: pass
+        thetas = self._draw(prior, size)
+        _, ps = self.evaluate(thetas)
+        return [(j, thetas[j], ps[j]) for j in np.flatnonzero(_within(ps, self.eps))]
+    
+    def _draw(self, prior, size):
+        if hasattr(prior, "sample"):
+            return prior.sample(size)
+        return np.array([prior() for _ in range(size)])
+
+class _AttemptsWrapper(object):  # @DontTrace
+    """
+    Wraps a chunk of simulation attempts of the dynamic scheduler.
+    Allows for pickling the functionality.
+    """
+    
+    def __init__(self, proposal):
+        self.proposal = proposal
+    
+    def __call__(self, task):
+        j, seed, size = task
+        return j, self.proposal.attempts(seed, size), size, _worker_id()
 
 def weighted_cov(values, weights):
     """
@@ -320,14 +608,62 @@ def weighted_cov(values, weights):
     :returns sigma: the weighted covariance matrix
     """
     
-    n = values.shape[1]
-    sigma = np.empty((n, n))
     w = weights.sum() / (weights.sum()**2 - (weights**2).sum()) 
     average = np.average(values, axis=0, weights=weights)
-    for j in range(n):
-        for k in range(n):
-            sigma[j, k] = w * np.sum(weights * ((values[:, j] - average[j]) * (values[:, k] - average[k])))
-    return sigma
+    diff = values - average
+    return w * np.dot(weights * diff.T, diff)
+
+
+def _sqrt_cov(sigma):
+    """
+    Returns a matrix L such that L L^T = sigma (cholesky factor, or from the eigen decomposition if sigma is singular)
+    """
+    sigma = np.atleast_2d(sigma)
+    try:
+        return np.linalg.cholesky(sigma)
+    except np.linalg.LinAlgError:
+        s, u = np.linalg.eigh(sigma)
+        return u * np.sqrt(np.maximum(s, 0))
+
+def _mahalanobis_transform(sigma):
+    """
+    Returns a matrix A such that (x-y)^T sigma^-1 (x-y) = |A(x-y)|^2.
+    Uses the cholesky factor of sigma, or its eigen decomposition (pseudo-inverse) if sigma is singular
+    """
+    sigma = np.atleast_2d(sigma)
+    try:
+        L = np.linalg.cholesky(sigma)
+        return linalg.solve_triangular(L, np.eye(len(sigma)), lower=True)
+    except np.linalg.LinAlgError:
+        s, u = np.linalg.eigh(sigma)
+        keep = s > np.max(np.abs(s)) * len(s) * np.finfo(float).eps
+        return (u[:, keep] / np.sqrt(s[keep])).T
+
+def importance_weights(prior, sigma, ws, prev_thetas, thetas):
+    """
+    Computes the normalised importance weights prior(theta) / sum_j ws_j K(theta, prev_theta_j) of a new population,
+    with K the gaussian kernel of covariance sigma. The kernel normalisation is the same for all particles and cancels out
+    
+    :param prior: the prior (a callable returning the density of a theta)
+    :param sigma: covariance matrix of the kernel
+    :param ws: weights of the previous population
+    :param prev_thetas: particles of the previous population
+    :param thetas: particles of the new population
+    
+    :returns ws: the normalised weights of the new population
+    """
+    A = _mahalanobis_transform(sigma)
+    z = np.dot(np.atleast_2d(thetas.T).T, A.T)
+    zp = np.dot(np.atleast_2d(prev_thetas.T).T, A.T)
+    # squared mahalanobis distances between all pairs of new and previous particles
+    d2 = np.sum(z**2, axis=1)[:, None] + np.sum(zp**2, axis=1)[None, :] - 2 * np.dot(z, zp.T)
+    np.maximum(d2, 0, out=d2)
+    
+    with np.errstate(divide="ignore"):
+        log_prior = np.log(np.array([prior(theta) for theta in thetas], dtype=float))
+        log_wt = log_prior - special.logsumexp(np.log(ws)[None, :] - 0.5 * d2, axis=1)
+    wt = np.exp(log_wt - np.max(log_wt))
+    return wt / np.sum(wt)
 
 
 def weighted_avg_and_std(values, weights, axis=None):
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+"""
+Output sinks for the results stored by the models (storeResults).
+
+A result is a table given as named columns of equal length. Each sink writes a whole table in one call,
+to its own file keyed by run id, so concurrent workers never write to the same file.
+"""
+
+import os, uuid
+
+import numpy as np
+
+__all__ = ["NpzSink", "CsvSink", "getSink"]
+
+def _runName(runId):
+    # unique name if the caller did not give a run id
+    if runId is None:
+        return str(os.getpid())+'_'+uuid.uuid4().hex
+    return str(runId)
+
+def _replace(tmpName, fileName):
+    # rename is atomic, so readers never see a partial file
+    os.replace(tmpName, fileName)
+
+class NpzSink(object):
+    """
+    Writes each table as a compressed .npz file (one array per column) named <directory>/<prefix>_<runId>.npz
+
+    :param directory: output directory (created if needed)
+    :param prefix: prefix of the file names
+    """
+
+    def __init__(self, directory='.', prefix='run'):
+        self.directory = directory
+        self.prefix = prefix
+
+    def fileName(self, runId):
+        return os.path.join(self.directory, self.prefix+'_'+str(runId)+'.npz')
+
+    def write(self, runId, table):
+        """
+        :param runId: identifier of the run (None for a unique one)
+        :param table: dict of column name -> 1-D array
+
+        :returns fileName: path of the written file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fileName = self.fileName(_runName(runId))
+        tmpName = fileName+'.'+uuid.uuid4().hex+'.tmp'
+        with open(tmpName, 'wb') as outputFile:
+            np.savez_compressed(outputFile, **table)
+        _replace(tmpName, fileName)
+        return fileName
+
+    def read(self, runId):
+        """
+        Returns the table of a run as a dict of column name -> array
+        """
+        with np.load(self.fileName(runId)) as data:
+            return {name: data[name] for name in data.files}
+
+    def runIds(self):
+        """
+        Returns the run ids stored in the directory
+        """
+        start = len(self.prefix)+1
+        return sorted(name[start:-4] for name in os.listdir(self.directory) if name.startswith(self.prefix+'_') and name.endswith('.npz'))
+
+class CsvSink(object):
+    """
+    Writes each table as a ;-separated csv file, the format of the original output.csv.
+    Without a run id the file is <directory>/<prefix>.csv, otherwise <directory>/<prefix>_<runId>.csv
+
+    :param directory: output directory (created if needed)
+    :param prefix: prefix of the file names
+    :param formats: (optional) dict of column name -> % format (default '%s')
+    """
+
+    def __init__(self, directory='.', prefix='output', formats=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.formats = formats or {}
+
+    def fileName(self, runId):
+        if runId is None:
+            return os.path.join(self.directory, self.prefix+'.csv')
+        return os.path.join(self.directory, self.prefix+'_'+str(runId)+'.csv')
+
+    def write(self, runId, table):
+        """
+        :param runId: identifier of the run (None for the legacy file name)
+        :param table: dict of column name -> 1-D array
+
+        :returns fileName: path of the written file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        columns = [np.char.mod(self.formats.get(name, '%s'), np.asarray(values)) for name, values in table.items()]
+        lines = columns[0]
+        for column in columns[1:]:
+            lines = np.char.add(np.char.add(lines, ';'), column)
+
+        fileName = self.fileName(runId)
+        tmpName = fileName+'.'+uuid.uuid4().hex+'.tmp'
+        with open(tmpName, 'w') as outputFile:
+            outputFile.write(';'.join(table.keys())+'\n')
+            if len(lines)>0:
+                outputFile.write('\n'.join(lines)+'\n')
+        _replace(tmpName, fileName)
+        return fileName
+
+def getSink(storeResults, formats=None):
+    """
+    Returns the sink for the storeResults argument of the models: None for False, a CsvSink writing output.csv
+    for True (with the column formats of the model), or storeResults itself if it is a sink
+    """
+    if storeResults is False or storeResults is None:
+        return None
+    if storeResults is True:
+        return CsvSink(formats=formats)
+    return storeResults
@@ -41,6 +41,12 @@ class EpsProposal(object):
     
     def reset(self):
         self.t = 0
+    
+    def update(self, pool):
+        """
+        Called by the Sampler with the population of each generation, before the next epsilon is drawn
+        """
+        pass
         
 class ListEps(EpsProposal):
     
@@ -121,3 +127,51 @@ class ExponentialConstEps(EpsProposal):
     def __call__(self, t):
         return self.eps_vals[t]
 
+class AdaptiveEps(EpsProposal):
+    """
+    Adaptive threshold: the epsilon of a generation is the quantile of the distances of the previous population
+    (per dimension for vector distances), and never increases.
+    Stops after T iterations, when the acceptance ratio of a generation falls below min_ratio, when epsilon decreases
+    by less than min_change (relative), or when it reaches min
+    
+    :param T: maximum number of iterations
+    :param eps: epsilon at t=0
+    :param quantile: (optional) quantile of the distances used as next epsilon
+    :param min_ratio: (optional) minimum acceptance ratio
+    :param min_change: (optional) minimum relative decrease of epsilon
+    :param min: (optional) target epsilon
+    """
+    
+    def __init__(self, T, eps, quantile=0.5, min_ratio=None, min_change=None, min=None):
+        self.eps0 = eps
+        self.quantile = quantile
+        self.min_ratio = min_ratio
+        self.min_change = min_change
+        self.min = min
+        super(AdaptiveEps, self).__init__(T)
+    
+    def reset(self):
+        super(AdaptiveEps, self).reset()
+        self.eps = np.asarray(self.eps0, dtype=float)
+        self.stopped = False
+    
+    def next(self):
+        if self.stopped:
+            raise StopIteration()
+        return super(AdaptiveEps, self).next()
+    
+    def __call__(self, t):
+        return self.eps
+    
+    def update(self, pool):
+        if self.min_ratio is not None and pool.ratio < self.min_ratio:
+            self.stopped = True
+        if self.min is not None and np.all(self.eps <= self.min):
+            self.stopped = True
+        
+        eps = np.minimum(np.quantile(pool.dists, self.quantile, axis=0), self.eps)
+        if self.min is not None:
+            eps = np.maximum(eps, self.min)
+        if self.min_change is not None and np.all(self.eps - eps < self.min_change * self.eps):
+            self.stopped = True
+        self.eps = eps
@@ -2,8 +2,14 @@
 
 import sampler
 import threshold
+import store
 import lognorm
 import numpy as np
+import argparse
+
+parser = argparse.ArgumentParser(description='ABC of the lognormal model')
+parser.add_argument('--resume', action='store_true', help='continue the run checkpointed in ./populations instead of starting a new one')
+args = parser.parse_args()
 
 def postfn(params):
     global costs
@@ -11,6 +17,12 @@ def postfn(params):
     simSizes = lognorm.run(experiment, False)
     return simSizes
 
+def batchPostfn(params):
+    experiments = [lognorm.Experiment(theta[0], theta[1], theta[2], theta[3], 140, costs, 230) for theta in params]
+    return lognorm.runBatch(experiments)
+
+postfn.batch = batchPostfn
+
 
 numSites = 140
 costs = lognorm.loadCosts('../data/costMatrixSea.csv',numSites)
@@ -19,14 +31,20 @@ data = lognorm.loadHistoricalSites(sites, numSites)
 eps = threshold.LinearEps(30, 6000, 3000)
 priors = sampler.TophatPrior([0,0,0,0.0001],[2,2,2,2])
 
-sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=lognorm.distAbs, threads=16)
+sampler = sampler.Sampler(N=200, Y=data, postfn=postfn, dist=lognorm.DistAbs(data), threads=16, batchSize=64)
+
+# every generation is checkpointed, and with --resume a restarted run continues after the last stored one
+populations = store.PopulationStore('populations')
 
-for pool in sampler.sample(priors, eps):
+pool = None
+for pool in sampler.sample(priors, eps, populations, resume=args.resume):
     print("T: {0}, eps: {1:>.4f}, ratio: {2:>.4f}".format(pool.t, pool.eps, pool.ratio))
     for i, (mean, std) in enumerate(zip(np.mean(pool.thetas, axis=0), np.std(pool.thetas, axis=0))):
         print(u"    theta[{0}]: {1:>.4f} \u00B1 {2:>.4f}".format(i, mean,std))
     np.savetxt("result_"+str('%.2f')%pool.eps+'.csv', pool.thetas, delimiter=";", fmt='%1.5f')
 
-print(pool.thetas)
-np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
+# a resumed run that was already complete yields no generation
+if pool is not None:
+    print(pool.thetas)
+    np.savetxt("foo.csv", pool.thetas, delimiter=";", fmt='%1.5f')
 
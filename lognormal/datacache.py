@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+
+"""
+Parse-once binary cache for the cost matrices and site tables.
+
+The csv files are converted the first time they are requested into index-aligned
+.npy files stored in a per-machine cache directory (ENTROPY_ABC_CACHE or ~/.cache/entropy_abc).
+Each entry is keyed by the sha1 of the csv content, so editing a csv invalidates it.
+Cached arrays are memory-mapped and memoised per process.
+"""
+
+import csv, hashlib, os, shutil, tempfile
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = ["CostMatrix", "SiteColumns", "loadCostMatrix", "loadSiteColumns", "fileHash"]
+
+cacheDir = os.environ.get('ENTROPY_ABC_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'entropy_abc'))
+
+"""Dense cost matrix where costs[i,j] is the cost from ids[i] to ids[j]"""
+CostMatrix = namedtuple("CostMatrix", ["ids", "costs"])
+
+"""Columns of a site table, in file order"""
+SiteColumns = namedtuple("SiteColumns", ["ids", "size", "x", "y", "isHarbour"])
+
+# arrays already loaded by this process: key -> (file signature, value)
+_loaded = {}
+
+def fileHash(fileName):
+    """
+    Returns the sha1 hex digest of the content of the file
+    """
+    digest = hashlib.sha1()
+    with open(fileName, 'rb') as inputFile:
+        for block in iter(lambda: inputFile.read(1<<20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _parseCosts(fileName):
+    codes = list()
+    values = list()
+    with open(fileName, 'r') as distFile:
+        csvReader = csv.reader(distFile, delimiter=';')
+        # skip header
+        next(csvReader)
+        for dist in csvReader:
+            codes.append(dist[0].split('_'))
+            values.append(float(dist[1]))
+
+    # sites are indexed in order of first appearance
+    index = {}
+    for code in codes:
+        for ident in code:
+            if ident not in index:
+                index[ident] = len(index)
+    costs = np.full([len(index), len(index)], np.nan)
+    rows = [index[code[0]] for code in codes]
+    cols = [index[code[1]] for code in codes]
+    costs[rows, cols] = values
+
+    ids = np.array(sorted(index, key=index.get))
+    # a missing pair must not be read as cost 0 (the strongest interaction), so the matrix is not cached
+    missing = np.argwhere(np.isnan(costs))
+    if len(missing)>0:
+        row, col = missing[0]
+        raise ValueError('%s: %d of %d pairs are missing or not a number, e.g. %s_%s' % (fileName, len(missing), costs.size, ids[row], ids[col]))
+    return {'ids': ids, 'costs': costs}
+
+def _parseSites(fileName):
+    ids = list()
+    size = list()
+    x = list()
+    y = list()
+    isHarbour = list()
+    with open(fileName, 'r') as inputFile:
+        csvReader = csv.reader(inputFile, delimiter=',')
+        # skip header
+        next(csvReader)
+        for siteLine in csvReader:
+            ids.append(siteLine[0])
+            size.append(float(siteLine[1]))
+            x.append(float(siteLine[3]))
+            y.append(float(siteLine[4]))
+            isHarbour.append(int(siteLine[7])!=0)
+    return {'ids': np.array(ids), 'size': np.array(size), 'x': np.array(x), 'y': np.array(y), 'isHarbour': np.array(isHarbour)}
+
+def _store(path, arrays):
+    # write to a temporary directory and rename it so concurrent workers never see a partial entry
+    os.makedirs(cacheDir, exist_ok=True)
+    tmpPath = tempfile.mkdtemp(dir=cacheDir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmpPath, name+'.npy'), array)
+    try:
+        os.rename(tmpPath, path)
+    except OSError:
+        # another process stored the same entry first
+        shutil.rmtree(tmpPath, ignore_errors=True)
+
+def _load(fileName, kind, parser, columns):
+    key = (os.path.abspath(fileName), kind)
+    stat = os.stat(fileName)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if key in _loaded and _loaded[key][0]==signature:
+        return _loaded[key][1]
+
+    path = os.path.join(cacheDir, kind+'_'+fileHash(fileName))
+    if not os.path.isdir(path):
+        _store(path, parser(fileName))
+    arrays = [np.load(os.path.join(path, name+'.npy'), mmap_mode='r') for name in columns]
+    _loaded[key] = (signature, arrays)
+    return arrays
+
+def loadCostMatrix(distFileName):
+    """
+    Loads a code;cost csv file (codes as <from>_<to>) as a dense matrix
+
+    :param distFileName: path to the csv file
+
+    :returns costMatrix: CostMatrix with site ids and a read-only memory-mapped cost matrix
+    """
+    return CostMatrix(*_load(distFileName, 'costs', _parseCosts, CostMatrix._fields))
+
+def loadSiteColumns(inputFileName):
+    """
+    Loads a site table csv file (id,size,elev,x,y,farming,prom,isCoast)
+
+    :param inputFileName: path to the csv file
+
+    :returns columns: SiteColumns with read-only memory-mapped arrays
+    """
+    return SiteColumns(*_load(inputFileName, 'sites', _parseSites, SiteColumns._fields))
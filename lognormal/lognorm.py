@@ -1,49 +1,134 @@
 #!/usr/bin/python3
 
 import numpy as np
-import csv
-
-def distAbs(x,y):  
-    maxValues = np.maximum(x,y)
-    minValues = np.minimum(x,y)
-    diff = np.sum(maxValues-minValues)
-    print('diff abs:',diff)
-    return diff
-
-def distLog(x,y):
-    # logarithmic to penalize huge sites
-    diff = np.sum(np.absolute(np.log(x)-np.log(y)))
-    print('diff log:',diff)
-    return diff
-
-def distPerc(x,y):
-    maxValues = np.maximum(x,y)
-    minValues = np.minimum(x,y)
-    diff = np.sum(maxValues/minValues)
-    print('diff perc:',diff)
-    return diff
+import warnings
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import datacache, sinks
+
+# 'numpy' or 'numba', see setBackend
+backend = 'numpy'
+
+def setBackend(name):
+    """
+    Selects the implementation of the redistribution step of applyUpdate: 'numpy', 'numba' or 'auto' (numba if installed).
+    It falls back to 'numpy' if numba is not installed. Compiled kernels are cached on disk (see NUMBA_CACHE_DIR)
+
+    :returns backend: the selected backend
+    """
+    global backend
+    if name not in ('numpy', 'numba', 'auto'):
+        raise ValueError('unknown backend: '+str(name))
+    if name!='numpy' and numba is None:
+        if name=='numba':
+            warnings.warn('numba is not installed, using the numpy backend')
+        name = 'numpy'
+    elif name=='auto':
+        name = 'numba'
+    backend = name
+    return backend
+
+def _redistribute(newWeights, poweredWeights, costs):
+    # entropy method: each site keeps 90% of its weight and spreads 10% proportionally to poweredWeights*costs[i]
+    numSites = newWeights.shape[0]
+    result = 0.9*newWeights
+    for i in range(numSites):
+        total = 0.0
+        for j in range(numSites):
+            total += poweredWeights[j]*costs[i,j]
+        factor = 0.1*newWeights[i]/total
+        for j in range(numSites):
+            result[j] += factor*poweredWeights[j]*costs[i,j]
+    return result
+
+if numba is not None:
+    _redistribute = numba.njit(cache=True, nogil=True)(_redistribute)
+
+class DistAbs:
+    """
+    Sum of absolute differences between observed and simulated sizes
+
+    :param observed: array with the historical sizes
+    :param verbose: print each computed distance
+    """
+
+    def __init__(self, observed, verbose=False):
+        self.observed = np.array(observed, dtype=float)
+        self.verbose = verbose
+
+    def batch(self, sizes):
+        """
+        :param sizes: K x N array with the final sizes of K simulations
+
+        :returns dists: distance of each simulation
+        """
+        diff = np.sum(np.absolute(sizes-self.observed), axis=-1)
+        if self.verbose:
+            print('diff abs:',diff)
+        return diff
+
+    def __call__(self, x, y=None):
+        """
+        Distance of one simulation, with the signature used by sampler.Sampler (y is the observed data set)
+        """
+        return self.batch(x)
+
+class DistLog(DistAbs):
+    """
+    Sum of absolute differences of log sizes. The log of the observed sizes is computed once
+    """
+
+    def __init__(self, observed, verbose=False):
+        super(DistLog, self).__init__(observed, verbose)
+        # logarithmic to penalize huge sites
+        self.logObserved = np.log(self.observed)
+
+    def batch(self, sizes):
+        diff = np.sum(np.absolute(np.log(sizes)-self.logObserved), axis=-1)
+        if self.verbose:
+            print('diff log:',diff)
+        return diff
+
+class DistPerc(DistAbs):
+    """
+    Sum of the ratios between the largest and the smallest of each pair of observed and simulated sizes
+    """
+
+    def batch(self, sizes):
+        diff = np.sum(np.maximum(sizes,self.observed)/np.minimum(sizes,self.observed), axis=-1)
+        if self.verbose:
+            print('diff perc:',diff)
+        return diff
+
+def distAbs(x,y,verbose=False):  
+    return DistAbs(x, verbose)(y)
+
+def distLog(x,y,verbose=False):
+    return DistLog(x, verbose)(y)
+
+def distPerc(x,y,verbose=False):
+    return DistPerc(x, verbose)(y)
 
 def loadHistoricalSites( inputFileName, numSites ):
+    columns = datacache.loadSiteColumns(inputFileName)
     sites = np.empty([numSites])
-    inputFile = open(inputFileName, 'r')
-    
-    csvReader = csv.reader(inputFile, delimiter=',')
-    headerLine = next(csvReader)
-
-    for siteLine in csvReader:
-        ident = int(siteLine[0])
-        size = float(siteLine[1])
-        sites[ident-1] = size
+    sites[columns.ids.astype(int)-1] = columns.size
     return sites    
 
 class Experiment:
-    def __init__(self, alpha, beta, meanlog, sdlog, numSites, costs, maxObservedSize):
+    def __init__(self, alpha, beta, meanlog, sdlog, numSites, costs, maxObservedSize, innovationRate=None):
         # priors
 
         self.alpha = alpha
         self.beta = beta
         self.meanlog = meanlog
         self.sdlog = sdlog
+        # if not None sites grow with their own strategy (initially meanlog), which diffuses between sites
+        self.innovationRate = innovationRate
 
         self.numSites = numSites
         self.costs = costs
@@ -54,20 +139,36 @@ class Experiment:
         return result
 
 def loadCosts( distFileName, numSites):
+    costMatrix = datacache.loadCostMatrix(distFileName)
+    idx = costMatrix.ids.astype(int)-1
     costs = np.empty([numSites,numSites])
-    distFile = open(distFileName, 'r')
-    csvReader = csv.reader(distFile, delimiter=';')
-    # skip header
-    next(csvReader)
-
-    for dist in csvReader:
-        code = dist[0].split('_')
-        cost = float(dist[1])
-        costs[int(code[0])-1,int(code[1])-1] = cost
+    costs[np.ix_(idx,idx)] = costMatrix.costs
     return costs           
 
 
+def growWeights(weights, meanlog, sdlog):
+    """
+    Lognormal growth step: each weight is multiplied by 1+N(meanlog, sdlog)
+    """
+    growth = 1+np.random.normal(meanlog, sdlog, weights.shape)
+    # a negative growth has no logarithm, so these sites become nan as in the log-space update
+    growth[growth<0] = np.nan
+    return weights*growth
+
 def applyUpdate(weights, costs, alpha, meanlog, sdlog):
+    newWeights = growWeights(weights, meanlog, sdlog)
+    poweredWeights = np.power(newWeights,alpha)
+    if backend=='numba':
+        return _redistribute(newWeights, poweredWeights, costs)
+
+    # entropy method: each site keeps 90% of its weight and spreads 10% over row-normalised poweredWeights*costs[i]
+    share = 0.1*newWeights/costs.dot(poweredWeights)
+    return 0.9*newWeights+poweredWeights*costs.T.dot(share)
+
+def applyUpdateLoop(weights, costs, alpha, meanlog, sdlog):
+    """
+    Original implementation of applyUpdate with a loop over the sites. It is kept as a reference
+    """
 #    newWeights = np.copy(weights)
     newWeights = np.exp(np.log(weights) + np.log(1+np.random.normal(meanlog, sdlog, len(weights))))
     # entropy method
@@ -92,52 +193,167 @@ def updateWeights(weights, strategies):
     return result               
 
 def updateStrategies(strategies, innovationRate):
-    result = np.copy(strategies)
-    for i in range(len(result)):
-        if np.random.uniform(0,1)<innovationRate:
-            newStrategy = np.random.normal(0,0.1)
-            if newStrategy > result[i]:
-                result[i] = newStrategy
-#            print('innovation!')
-    return result
+    """
+    Each site innovates with probability innovationRate, drawing a new strategy from N(0, 0.1).
+    The new strategy is only adopted if it is better than the current one.
+    strategies can also be a R x numSites array of R simulations, with innovationRate of shape R x 1
+    """
+    innovates = np.random.uniform(0, 1, strategies.shape)<innovationRate
+    newStrategies = np.random.normal(0, 0.1, strategies.shape)
+    return np.where(np.logical_and(innovates, newStrategies>strategies), newStrategies, strategies)
 
 def selectStrategies(strategies, costs, weights, alpha):
-    result = np.copy(strategies)
+    """
+    Each site picks another site with probability proportional to weight^alpha*cost and copies its strategy if it is better.
+    All sites are drawn at once by inverting the cumulative sum of each row.
+    strategies and weights can also be R x numSites arrays of R simulations, with alpha of shape R x 1 and costs shared
+    or R x numSites x numSites
+    """
     poweredWeights = np.power(weights,alpha)
     # it should be linked to communication cost
-    for i in range(len(result)):
-        finalCosts = poweredWeights*costs[i]
-        finalCosts = finalCosts/np.sum(finalCosts)
-        strategyToCopy = np.random.choice(strategies, p=finalCosts)
-        if strategyToCopy > strategies[i]:
-            result[i] = strategyToCopy 
-    return result
+    cumulative = np.cumsum(costs*poweredWeights[...,None,:], axis=-1)
+    draws = np.random.uniform(0, 1, strategies.shape)*cumulative[...,-1]
+    chosen = np.minimum(np.sum(cumulative<draws[...,None], axis=-1), strategies.shape[-1]-1)
+    return np.maximum(strategies, np.take_along_axis(strategies, chosen, axis=-1))
+
+class MaxSize:
+    """
+    Observer for run that keeps the size of the largest site at each step
+    """
+
+    def __init__(self):
+        self.values = list()
+
+    def __call__(self, step, weights):
+        self.values.append(np.amax(weights))
+
+class RankSizeSlope:
+    """
+    Observer for run that keeps the slope of the log rank-log size regression at each step
+    """
+
+    def __init__(self):
+        self.values = list()
+        self.logRank = None
+
+    def __call__(self, step, weights):
+        if self.logRank is None:
+            # centered log rank, fixed for the whole run
+            logRank = np.log(np.arange(1, len(weights)+1))
+            self.logRank = logRank-np.mean(logRank)
+            self.sumSquares = np.sum(self.logRank*self.logRank)
+        logSize = np.log(np.sort(weights)[::-1])
+        self.values.append(np.sum(self.logRank*logSize)/self.sumSquares)
+
+def run(experiment, storeResults, maxSteps=1000, observers=None, runId=None):
+    """
+    Runs the lognormal growth model until the largest site reaches maxObservedSize or maxSteps steps.
+    Only the current sizes are kept unless the trajectory has to be stored.
+    If experiment.innovationRate is set, the mean growth of each site is its strategy: at each step sites innovate
+    (updateStrategies) and copy better strategies from other sites (selectStrategies) before growing
+
+    :param experiment: Experiment with the parameters of the run
+    :param storeResults: True to write the whole trajectory to output.csv, or a sink (see sinks.NpzSink)
+    :param maxSteps: maximum number of steps (including the initial state)
+    :param observers: (optional) list of callables observer(step, weights) called after each step (see MaxSize and RankSizeSlope)
+    :param runId: (optional) key of the stored trajectory in the sink
 
-def run(experiment, storeResults):
-    maxSteps = 1000
+    :returns weights: final size of each site
+    """
+    if observers is None:
+        observers = list()
 
-    weights = np.empty([experiment.numSites, maxSteps])
-    weights[:,0] = np.full(experiment.numSites, 1)
+    weights = np.full(experiment.numSites, 1.0)
+    history = None
+    if storeResults:
+        history = [weights]
 
     costs = np.exp(-1.0*experiment.beta*experiment.costs)
 
+    meanlog = experiment.meanlog
+    if experiment.innovationRate is not None:
+        meanlog = np.full(experiment.numSites, experiment.meanlog)
+
     maxSize = 1
     i = 1
 
     while maxSize<experiment.maxObservedSize and i<maxSteps:
-        weights[:,i] = applyUpdate(weights[:,i-1], costs, experiment.alpha, experiment.meanlog, experiment.sdlog)
-        maxSize = np.amax(weights[:,i])
+        if experiment.innovationRate is not None:
+            meanlog = updateStrategies(meanlog, experiment.innovationRate)
+            meanlog = selectStrategies(meanlog, costs, weights, experiment.alpha)
+        weights = applyUpdate(weights, costs, experiment.alpha, meanlog, experiment.sdlog)
+        maxSize = np.amax(weights)
 #        print('step:',i,'max size:',maxSize)
+        for observer in observers:
+            observer(i, weights)
+        if history is not None:
+            history.append(weights)
         i += 1
     
-    if(storeResults):
-        output = open('output.csv', 'w')
-        output.write('step;site;size\n')
-
-        for z in range(i):
-            for j in range(experiment.numSites):
-                output.write(str(z)+';'+str(j)+';'+str(weights[j,z])+'\n')
-        output.close()
-    
-    return weights[:,i-1]
+    sink = sinks.getSink(storeResults)
+    if sink is not None:
+        # long format, one row per step and site
+        history = np.array(history)
+        steps, numSites = history.shape
+        sink.write(runId, {'step': np.repeat(np.arange(steps), numSites), 'site': np.tile(np.arange(numSites), steps), 'size': history.ravel()})
+
+    return weights
+
+def runBatch(experiments, maxSteps=1000):
+    """
+    Runs R simulations at once as a R x numSites state, drawing the noise of each step in bulk.
+    Each simulation stops when its largest site reaches its maxObservedSize, and then it is no longer updated.
+    Simulations with innovationRate update their strategies at each step as in run
+
+    :param experiments: list of R Experiment with the same sites and costs (repeat an experiment to get replicates)
+    :param maxSteps: maximum number of steps (including the initial state)
+
+    :returns weights: R x numSites array with the final sizes of each simulation
+    """
+    alpha = np.array([experiment.alpha for experiment in experiments], dtype=float)
+    beta = np.array([experiment.beta for experiment in experiments], dtype=float)
+    meanlog = np.array([experiment.meanlog for experiment in experiments], dtype=float)
+    innovationRate = np.array([np.nan if experiment.innovationRate is None else experiment.innovationRate for experiment in experiments], dtype=float)
+    sdlog = np.array([experiment.sdlog for experiment in experiments], dtype=float)
+    maxObservedSize = np.array([experiment.maxObservedSize for experiment in experiments], dtype=float)
+
+    # a single kernel is shared if all the simulations have the same beta
+    sharedKernel = np.all(beta==beta[0])
+    if sharedKernel:
+        costs = np.exp(-1.0*beta[0]*experiments[0].costs)
+    else:
+        costs = np.exp(-1.0*beta[:,None,None]*experiments[0].costs)
+
+    weights = np.full([len(experiments), experiments[0].numSites], 1.0)
+    # mean growth of each site, the strategies of the simulations with innovationRate
+    meanlog = np.repeat(meanlog[:,None], weights.shape[1], axis=1)
+    innovates = ~np.isnan(innovationRate)
+    # simulations that are still running
+    active = np.arange(len(experiments))
+    i = 1
+    while len(active)>0 and i<maxSteps:
+        strategic = active[innovates[active]]
+        if len(strategic)>0:
+            meanlog[strategic] = updateStrategies(meanlog[strategic], innovationRate[strategic,None])
+            meanlog[strategic] = selectStrategies(meanlog[strategic], costs if sharedKernel else costs[strategic], weights[strategic], alpha[strategic,None])
+        newWeights = growWeights(weights[active], meanlog[active], sdlog[active,None])
+        poweredWeights = np.power(newWeights, alpha[active,None])
+        if sharedKernel:
+            share = 0.1*newWeights/poweredWeights.dot(costs.T)
+            weights[active] = 0.9*newWeights+poweredWeights*share.dot(costs)
+        else:
+            share = 0.1*newWeights/np.einsum('rij,rj->ri', costs[active], poweredWeights)
+            weights[active] = 0.9*newWeights+poweredWeights*np.einsum('rij,ri->rj', costs[active], share)
+
+        maxSize = np.amax(weights[active], axis=1)
+        active = active[maxSize<maxObservedSize[active]]
+        i += 1
+    return weights
+
+def runReplicates(experiment, replicates, maxSteps=1000):
+    """
+    Runs R replicates of an experiment at once, see runBatch
 
+    :returns weights: replicates x numSites array with the final sizes of each replicate
+    """
+    return runBatch([experiment]*replicates, maxSteps)
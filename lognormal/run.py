@@ -2,6 +2,7 @@
 
 import lognorm
 import numpy as np
+import timeit
 
 def main():
     alpha = 0.9
@@ -20,7 +21,7 @@ def singleRun(alpha,beta,meanlog,sdlog):
     data = lognorm.loadHistoricalSites(sites, numSites)
     experiment = lognorm.Experiment(alpha,beta,meanlog,sdlog, numSites, costs, np.amax(data))
     result = lognorm.run(experiment, True)
-    dist = lognorm.distPerc(data, result)
+    dist = lognorm.distPerc(data, result, verbose=True)
 
 def multipleRuns(alpha,beta,meanlog,sdlog):
     numRuns = 100
@@ -32,10 +33,31 @@ def multipleRuns(alpha,beta,meanlog,sdlog):
 
     data = lognorm.loadHistoricalSites(sites, numSites)
 
-    for i in range(numRuns):
-        experiment = lognorm.Experiment(alpha,beta,meanlog, sdlog, numSites, costs, np.amax(data))
-        result = lognorm.run(experiment, True)
-        dist = lognorm.distPerc(data, result)
+    experiment = lognorm.Experiment(alpha,beta,meanlog, sdlog, numSites, costs, np.amax(data))
+    results = lognorm.runReplicates(experiment, numRuns)
+    dists = lognorm.DistPerc(data).batch(results)
+    print('diff perc - mean:',np.mean(dists),'5%, 50%, 95%:',np.percentile(dists, [5,50,95]))
+
+def benchmarkUpdate(alpha=0.9,beta=0.05,meanlog=0.1,sdlog=0.1,repeats=200):
+    """
+    Compares the loop, vectorized and (if installed) numba versions of applyUpdate
+    """
+    numSites = 140
+    costs = np.exp(-1.0*beta*lognorm.loadCosts('../data/costMatrixSea.csv',numSites))
+    weights = np.full(numSites, 1.0)
+
+    np.random.seed(0)
+    reference = lognorm.applyUpdateLoop(weights, costs, alpha, meanlog, sdlog)
+    timeLoop = timeit.timeit(lambda: lognorm.applyUpdateLoop(weights, costs, alpha, meanlog, sdlog), number=repeats)
+    print('loop: {0:.2f} us per update'.format(1e6*timeLoop/repeats))
+
+    for backend in ['numpy', 'numba']:
+        if lognorm.setBackend(backend)!=backend:
+            continue
+        np.random.seed(0)
+        diff = np.max(np.absolute(lognorm.applyUpdate(weights, costs, alpha, meanlog, sdlog)-reference))
+        elapsed = timeit.timeit(lambda: lognorm.applyUpdate(weights, costs, alpha, meanlog, sdlog), number=repeats)
+        print('{0}: {1:.2f} us per update, speedup: {2:.1f}, max diff: {3}'.format(backend, 1e6*elapsed/repeats, timeLoop/elapsed, diff))
 
 if __name__ == "__main__":
     main()
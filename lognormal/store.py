@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+"""
+Append-only store of the populations of a Sampler run, used to checkpoint and resume runs (see Sampler.sample).
+
+Each generation is a directory gen_<t> with the arrays of the population (thetas.npy, dists.npy, ws.npy, or a single
+compressed population.npz) and meta.json with t, eps, ratio, the simulation counts and the state of the global numpy generator.
+Generations are written to a temporary directory and renamed, so an interrupted run never leaves a partial generation.
+"""
+
+import json, os, shutil, tempfile
+
+import numpy as np
+
+from sampler import PoolSpec
+
+__all__ = ["PopulationStore"]
+
+_ARRAYS = ["thetas", "dists", "ws"]
+
+class PopulationStore(object):
+    """
+    :param directory: directory of the store (created if needed)
+    :param compress: (optional) write the arrays of new generations as a compressed npz instead of npy files.
+        Compressed generations can not be memory-mapped
+    """
+
+    def __init__(self, directory, compress=False):
+        self.directory = directory
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, t):
+        return os.path.join(self.directory, 'gen_%05d' % t)
+
+    def generations(self):
+        """
+        Returns the complete generations, in order
+        """
+        return sorted(int(name[4:]) for name in os.listdir(self.directory) if name.startswith('gen_') and name[4:].isdigit())
+
+    def __len__(self):
+        return len(self.generations())
+
+    def __iter__(self):
+        for t in self.generations():
+            yield self.load(t)
+
+    def append(self, pool, cnts=None, workerAttempts=None, randomState=None):
+        """
+        Writes a generation
+
+        :param pool: PoolSpec of the generation
+        :param cnts: (optional) total number of simulations of the generation
+        :param workerAttempts: (optional) dict of the simulations of each worker
+        :param randomState: (optional) state of the global numpy generator (np.random.get_state())
+        """
+        path = self._path(pool.t)
+        if os.path.exists(path):
+            raise ValueError('generation %d is already stored in %s' % (pool.t, self.directory))
+
+        meta = {'t': int(pool.t), 'eps': np.asarray(pool.eps).tolist(), 'ratio': float(pool.ratio),
+                'cnts': None if cnts is None else int(cnts), 'workerAttempts': workerAttempts or {}}
+        arrays = {name: np.asarray(getattr(pool, name)) for name in _ARRAYS}
+        if randomState is not None:
+            name, keys, pos, hasGauss, cachedGaussian = randomState
+            meta['rng'] = [name, int(pos), int(hasGauss), float(cachedGaussian)]
+            arrays['rng_keys'] = keys
+
+        tmpPath = tempfile.mkdtemp(dir=self.directory)
+        if self.compress:
+            np.savez_compressed(os.path.join(tmpPath, 'population.npz'), **arrays)
+        else:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmpPath, name+'.npy'), array)
+        with open(os.path.join(tmpPath, 'meta.json'), 'w') as metaFile:
+            json.dump(meta, metaFile)
+        try:
+            os.rename(tmpPath, path)
+        except OSError:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            raise
+
+    def meta(self, t):
+        """
+        Returns the dict with t, eps, ratio, cnts, workerAttempts (and rng) of a generation
+        """
+        with open(os.path.join(self._path(t), 'meta.json'), 'r') as metaFile:
+            return json.load(metaFile)
+
+    def _arrays(self, t, mmap):
+        path = self._path(t)
+        if os.path.exists(os.path.join(path, 'population.npz')):
+            # the members of a npz are only read when accessed
+            return np.load(os.path.join(path, 'population.npz'))
+        names = [name[:-4] for name in os.listdir(path) if name.endswith('.npy')]
+        return {name: np.load(os.path.join(path, name+'.npy'), mmap_mode='r' if mmap else None) for name in names}
+
+    def load(self, t, mmap=True):
+        """
+        Reads a generation
+
+        :param t: generation
+        :param mmap: (optional) memory-map the arrays (read-only) instead of reading them
+
+        :returns pool: PoolSpec of the generation
+        """
+        meta = self.meta(t)
+        arrays = self._arrays(t, mmap)
+        return PoolSpec(meta['t'], np.asarray(meta['eps']) if isinstance(meta['eps'], list) else meta['eps'], meta['ratio'],
+                        *[arrays[name] for name in _ARRAYS])
+
+    def randomState(self, t):
+        """
+        Returns the state of the global numpy generator after generation t, for np.random.set_state (None if not stored)
+        """
+        meta = self.meta(t)
+        if 'rng' not in meta:
+            return None
+        name, pos, hasGauss, cachedGaussian = meta['rng']
+        return (name, np.asarray(self._arrays(t, False)['rng_keys']), pos, hasGauss, cachedGaussian)
@@ -12,29 +12,30 @@ def main():
     costFile = '../data/costMatrix.csv'
     sitesFile = '../data/cities_weights.csv'
 
-    baseCost = entropy.loadLandCostsInMeters(costFile)
+    costs = entropy.loadCosts(costFile)
     sites = entropy.loadHistoricalSites(sitesFile)
+    baseCost = entropy.costMatrix(costs, sites)
 
     seaCostFile = '../data/costMatrixSea.csv'
     seaCost = open(seaCostFile, 'w')
     seaCost.write('code;cost\n')
     
-    for fromSite in sites:
-        print('checking sea connections for:',fromSite)
-        for toSite in sites:
-            code = str(fromSite.ident)+'_'+str(toSite.ident)
-            if toSite is fromSite:
+    for i in range(len(sites)):
+        print('checking sea connections for site:',sites.ids[i])
+        for j in range(len(sites)):
+            code = str(sites.ids[i])+'_'+str(sites.ids[j])
+            if i==j:
                 seaCost.write(code+';0\n')
                 continue
             # write land values
-            elif not fromSite.isHarbour or not toSite.isHarbour:
-                seaCost.write(code+';'+str(entropy.Site.cost[code])+'\n')
+            elif not sites.isHarbour[i] or not sites.isHarbour[j]:
+                seaCost.write(code+';'+str(baseCost[i,j])+'\n')
                 continue
-            print('\tfrom:',fromSite.ident,'to:',toSite.ident,'sea connection')
-            distance = math.sqrt(math.pow(toSite.x-fromSite.x,2)+math.pow(toSite.y-fromSite.y,2))/1000
+            print('\tfrom:',sites.ids[i],'to:',sites.ids[j],'sea connection')
+            distance = math.sqrt(math.pow(sites.x[j]-sites.x[i],2)+math.pow(sites.y[j]-sites.y[i],2))/1000
             travelDays = distance/speedKmDay
-            print('\tland cost',entropy.Site.cost[code],'sea cost:',travelDays,'with distance:',distance)
-            finalDist = min(travelDays, entropy.Site.cost[code])
+            print('\tland cost',baseCost[i,j],'sea cost:',travelDays,'with distance:',distance)
+            finalDist = min(travelDays, baseCost[i,j])
             seaCost.write(code+';'+str(finalDist)+'\n') 
     seaCost.close()
 